@@ -0,0 +1,82 @@
+"""
+Micro-benchmark of the event ingestion of the watch tree. A single thread
+plays the role of the inotify loop and adds files round-robin to a number
+of concurrently busy directories, while the batch scheduler takes the
+pending batches and hands them to a no-op file handler.
+
+Run from the repository root:
+    python -m benchmark.ingest [--events N] [--delay S] [--dirs 1 8 64]
+"""
+import time
+import argparse
+import threading
+from changeover.common import watchtree
+
+
+class CountingHandler(watchtree.WatchTreeFileHandler):
+    """
+    File handler that only counts the processed batches and files.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.files = 0
+
+    def process(self, path, file_list):
+        self.lock.acquire()
+        try:
+            self.batches += 1
+            self.files += len(file_list)
+        finally:
+            self.lock.release()
+
+
+def run(n_dirs, n_events, delay, workers):
+    """
+    Feeds n_events files into n_dirs directories and returns a dictionary
+    with the ingestion rate and the number of processed batches and files.
+    """
+    handler = CountingHandler()
+    scheduler = watchtree.BatchScheduler(handler, delay, workers)
+    scheduler.start()
+    paths = ["/bench/dir%03i"%i for i in range(n_dirs)]
+    names = ["frame_%06i.tif"%i for i in range(n_events)]
+
+    start_time = time.time()
+    for i in range(n_events):
+        scheduler.add(paths[i%n_dirs], names[i])
+    elapsed = time.time()-start_time
+
+    # wait for the scheduler to hand out the remaining batches
+    timeout = time.time()+delay+10
+    while handler.files < n_events and time.time() < timeout:
+        time.sleep(0.01)
+    scheduler.stop()
+    return {'dirs': n_dirs,
+            'events_per_s': n_events/elapsed,
+            'batches': handler.batches,
+            'files': handler.files}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='benchmark.ingest',
+                                     description='watch tree ingestion benchmark')
+    parser.add_argument('--events', type=int, default=200000,
+                        help='number of events per run')
+    parser.add_argument('--delay', type=float, default=0.01,
+                        help='batch delay in seconds')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of file handler workers')
+    parser.add_argument('--dirs', type=int, nargs='+', default=[1, 8, 64],
+                        help='numbers of concurrently busy directories')
+    args = parser.parse_args()
+
+    print "%6s %14s %10s %10s"%("dirs", "events/s", "batches", "files")
+    for n_dirs in args.dirs:
+        result = run(n_dirs, args.events, args.delay, args.workers)
+        print "%6i %14.0f %10i %10i"%(result['dirs'], result['events_per_s'],
+                                      result['batches'], result['files'])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""
+End-to-end benchmark of the archiving pipeline. Synthetic detector write
+patterns are played into a source tree (ideally on a tmpfs), which is watched
+by a WatchTree with the real EventHandler. The archive is a local directory
+and the SSH commands run in a local shell (see benchmark.localtarget). For
+each pattern the latency from closing a file to the file being archived is
+reported together with the throughput.
+
+Run from the repository root:
+    python -m benchmark.latency [--root /dev/shm/saxs-bench] [--delay 1]
+"""
+import os
+import imp
+import time
+import shutil
+import getpass
+import argparse
+import threading
+import grp
+import paramiko
+from changeover.common import settings, syncutils, watchtree
+from benchmark import localtarget
+
+# changeover.rsync sets up the daemon when it is imported, so the event
+# handler module is loaded on its own
+eventhandler = imp.load_source("eventhandler",
+                               os.path.join(os.path.dirname(__file__), "..",
+                                            "changeover", "rsync",
+                                            "eventhandler.py"))
+
+CONFIG = """[logging]
+debug =
+sentry =
+
+[rsync]
+compress = false
+checksum = false
+exclude = []
+delay = %(delay)s
+workers = %(workers)s
+max_files = %(max_files)s
+max_bytes = %(max_bytes)s
+max_latency = %(max_latency)s
+
+[reconcile]
+ledger =
+
+[source]
+watch = %(root)s/source
+folder = %(root)s/source/${cycle}/${epn}
+exclude =
+
+[target]
+host =
+user = %(user)s
+sudo = false
+folder = %(root)s/archive/${cycle}/${epn}
+permission = 755
+owner = %(user)s
+group = %(group)s
+
+[statistics]
+file = %(root)s/bench.stat
+frequency = 100
+"""
+
+
+class TimingHandler(eventhandler.EventHandler):
+    """
+    Event handler that records the time at which each file was archived.
+    """
+    def __init__(self):
+        super(TimingHandler, self).__init__()
+        self.lock = threading.Lock()
+        self.done = {}
+
+    def process(self, path, file_list):
+        super(TimingHandler, self).process(path, file_list)
+        now = time.time()
+        _, target = syncutils.build_sync_paths(path)
+        self.lock.acquire()
+        try:
+            for f in file_list:
+                if os.path.exists(os.path.join(target, f)):
+                    self.done.setdefault(os.path.join(path, f), now)
+        finally:
+            self.lock.release()
+
+
+def write_file(path, data, written):
+    """
+    Writes a file and records the time it was closed.
+    """
+    with open(path, 'wb') as f:
+        f.write(data)
+    written[path] = time.time()
+
+
+def steady(folders, n_files, data, written, rate=10.0):
+    """
+    A single detector writing frames into one folder at a fixed frame rate.
+    """
+    for i in range(n_files):
+        write_file(os.path.join(folders[0], "frame_%06i.tif"%i), data, written)
+        time.sleep(1.0/rate)
+
+
+def burst(folders, n_files, data, written):
+    """
+    A single detector dumping frames into one folder as fast as possible.
+    """
+    for i in range(n_files):
+        write_file(os.path.join(folders[0], "frame_%06i.tif"%i), data, written)
+
+
+def many_folders(folders, n_files, data, written):
+    """
+    Frames spread round-robin across many small sample folders.
+    """
+    for i in range(n_files):
+        folder = folders[i%len(folders)]
+        write_file(os.path.join(folder, "frame_%06i.dat"%i), data, written)
+
+
+PATTERNS = [('steady', steady, 1),
+            ('burst', burst, 1),
+            ('many_folders', many_folders, 50)]
+
+
+def percentile(values, fraction):
+    """
+    Returns the percentile of a sorted list of values
+    """
+    if not values:
+        return float('nan')
+    return values[min(len(values)-1, int(fraction*len(values)))]
+
+
+def report(name, written, done, size):
+    """
+    Prints the latency and throughput of a pattern.
+    """
+    latencies = sorted(done[p]-written[p] for p in written if p in done)
+    n_done = len(latencies)
+    if n_done > 0:
+        elapsed = max(done[p] for p in written if p in done) - \
+                  min(written.itervalues())
+    else:
+        elapsed = float('nan')
+    print "%-14s %6i/%-6i %9.3f %9.3f %9.3f %9.1f %9.2f"%\
+          (name, n_done, len(written),
+           percentile(latencies, 0.5), percentile(latencies, 0.99),
+           latencies[-1] if latencies else float('nan'),
+           n_done/elapsed, n_done*size/elapsed/1e6)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='benchmark.latency',
+                                     description='end-to-end archive latency benchmark')
+    parser.add_argument('--root', default='/dev/shm/saxs-bench',
+                        help='scratch directory, ideally on a tmpfs')
+    parser.add_argument('--files', type=int, default=500,
+                        help='number of files per pattern')
+    parser.add_argument('--size', type=int, default=1000000,
+                        help='size of each file in bytes')
+    parser.add_argument('--delay', type=float, default=1,
+                        help='batch delay in seconds')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of file handler workers')
+    parser.add_argument('--max-files', type=int, default=0,
+                        help='maximum number of files per batch')
+    parser.add_argument('--max-bytes', type=int, default=0,
+                        help='maximum number of bytes per batch')
+    parser.add_argument('--max-latency', type=float, default=0,
+                        help='maximum latency of a batch in seconds')
+    parser.add_argument('--timeout', type=float, default=120,
+                        help='time in seconds to wait for a pattern to finish')
+    args = parser.parse_args()
+
+    # build the scratch tree and the settings
+    if os.path.exists(args.root):
+        shutil.rmtree(args.root)
+    os.makedirs(os.path.join(args.root, "archive"))
+    folders = {}
+    for name, _, n_folders in PATTERNS:
+        folders[name] = []
+        for i in range(n_folders):
+            folder = os.path.join(args.root, "source", "bench", "%s_%03i"%(name, i))
+            os.makedirs(folder)
+            folders[name].append(folder)
+    conf_path = os.path.join(args.root, "bench.conf")
+    with open(conf_path, 'w') as f:
+        f.write(CONFIG%{'root': args.root,
+                        'delay': args.delay,
+                        'workers': args.workers,
+                        'max_files': args.max_files,
+                        'max_bytes': args.max_bytes,
+                        'max_latency': args.max_latency,
+                        'user': getpass.getuser(),
+                        'group': grp.getgrgid(os.getgid()).gr_name})
+    settings.read(conf_path)
+    paramiko.SSHClient = localtarget.LocalSSHClient
+
+    # start watching
+    handler = TimingHandler()
+    wt = watchtree.WatchTree(handler, "", args.delay, args.workers,
+                             args.max_files, args.max_bytes, args.max_latency)
+    wt.create(os.path.join(args.root, "source"))
+    thread = threading.Thread(target=wt.watch)
+    thread.daemon = True
+    thread.start()
+
+    print "%-14s %13s %9s %9s %9s %9s %9s"%("pattern", "archived", "p50 [s]",
+                                           "p99 [s]", "max [s]", "files/s", "MB/s")
+    data = os.urandom(args.size)
+    for name, pattern, _ in PATTERNS:
+        written = {}
+        pattern(folders[name], args.files, data, written)
+        timeout = time.time()+args.timeout
+        while time.time() < timeout:
+            if all(p in handler.done for p in written):
+                break
+            time.sleep(0.05)
+        report(name, written, handler.done, args.size)
+
+    shutil.rmtree(args.root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Local stand-in for the archive server. LocalSSHClient has the interface of
+the parts of paramiko.SSHClient the archiving code uses, but runs the
+commands in a local shell. Together with an empty target host, which makes
+rsync copy into a local directory, the archiving pipeline can be measured
+without a remote server.
+"""
+import os
+import threading
+from cStringIO import StringIO
+from subprocess import Popen, PIPE
+
+
+class LocalCommand(object):
+    """
+    A shell command that is started right away. Like a SSH channel, its
+    input and output are streamed, so writing the input and reading the
+    output at the same time behaves as on the archive server.
+    """
+    def __init__(self, cmd):
+        self._proc = Popen(["sh", "-c", cmd], stdin=PIPE, stdout=PIPE,
+                           stderr=PIPE)
+        self._stderr = []
+        self._drain = threading.Thread(target=self._read_stderr)
+        self._drain.daemon = True
+        self._drain.start()
+
+    def _read_stderr(self):
+        self._stderr.append(self._proc.stderr.read())
+
+    def stream(self, index):
+        if index == 0:
+            return self._proc.stdout
+        self._drain.join()
+        return StringIO("".join(self._stderr))
+
+    def write(self, data):
+        self._proc.stdin.write(data)
+
+    def recv_exit_status(self):
+        self._proc.wait()
+        return self._proc.returncode
+
+    def shutdown_write(self):
+        if not self._proc.stdin.closed:
+            self._proc.stdin.close()
+
+
+class LocalFile(object):
+    """
+    File-like object for the standard streams of a local command.
+    """
+    def __init__(self, command, index=None):
+        self.channel = command
+        self._command = command
+        self._index = index
+        self._buffer = None
+
+    def _stream(self):
+        if self._buffer == None:
+            self._buffer = self._command.stream(self._index)
+        return self._buffer
+
+    def write(self, data):
+        self._command.write(data)
+
+    def read(self, size=-1):
+        return self._stream().read(size)
+
+    def readline(self):
+        return self._stream().readline()
+
+    def __iter__(self):
+        return iter(self._stream().readline, "")
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._index == None:
+            self._command.shutdown_write()
+
+
+class LocalTransport(object):
+    """
+    Transport stand-in that is always active.
+    """
+    def is_active(self):
+        return True
+
+    def set_keepalive(self, interval):
+        pass
+
+
+class LocalChannel(object):
+    """
+    Channel stand-in that is always open.
+    """
+    closed = False
+
+
+class LocalSFTPFile(file):
+    """
+    Local file with the pipelining switch of paramiko.SFTPFile.
+    """
+    def set_pipelined(self, pipelined=True):
+        pass
+
+
+class LocalSFTPClient(object):
+    """
+    Drop-in replacement for the parts of paramiko.SFTPClient the archiving
+    code uses, working on local paths.
+    """
+    def __init__(self):
+        self._channel = LocalChannel()
+
+    def get_channel(self):
+        return self._channel
+
+    def stat(self, path):
+        try:
+            return os.stat(path)
+        except OSError, e:
+            raise IOError(e.errno, e.strerror)
+
+    def open(self, path, mode='r'):
+        return LocalSFTPFile(path, mode)
+
+    def utime(self, path, times):
+        os.utime(path, times)
+
+    def posix_rename(self, oldpath, newpath):
+        os.rename(oldpath, newpath)
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError, e:
+            raise IOError(e.errno, e.strerror)
+
+    def close(self):
+        pass
+
+
+class LocalSSHClient(object):
+    """
+    Drop-in replacement for paramiko.SSHClient that runs the commands
+    locally instead of on the archive server.
+    """
+    def __init__(self):
+        self._transport = LocalTransport()
+
+    def set_missing_host_key_policy(self, policy):
+        pass
+
+    def connect(self, hostname, **kwargs):
+        pass
+
+    def get_transport(self):
+        return self._transport
+
+    def open_sftp(self):
+        return LocalSFTPClient()
+
+    def exec_command(self, cmd, **kwargs):
+        command = LocalCommand(cmd)
+        return LocalFile(command), LocalFile(command, 0), LocalFile(command, 1)
+
+    def close(self):
+        pass
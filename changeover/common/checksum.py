@@ -0,0 +1,222 @@
+import socket
+import hashlib
+import logging
+import threading
+import multiprocessing
+
+logger = logging.getLogger(__name__)
+
+# the remote commands of the supported hash algorithms
+REMOTE_COMMANDS = {'md5': "md5sum",
+                   'sha1': "sha1sum",
+                   'sha224': "sha224sum",
+                   'sha256': "sha256sum",
+                   'sha384': "sha384sum",
+                   'sha512': "sha512sum"}
+
+# exit codes of xargs if all hash commands ran. 123: some files couldn't be
+# read, they are missing from the result
+XARGS_PARTIAL = [0, 123]
+
+# size of the chunks in which the source files are read
+CHUNK_SIZE = 4194304
+
+
+def hash_file(args):
+    """
+    Returns the path and the hex digest of a file, or the path and None if
+    the file can't be read. Runs in the worker processes of hash_local().
+    args: tuple of the path, the name of the hash algorithm and the chunk size
+    """
+    path, algorithm, chunk_size = args
+    digest = hashlib.new(algorithm)
+    try:
+        f = open(path, 'rb')
+        try:
+            while True:
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                digest.update(data)
+        finally:
+            f.close()
+    except IOError:
+        return path, None
+    return path, digest.hexdigest()
+
+
+def hash_local(paths, algorithm="md5", processes=0, chunk_size=CHUNK_SIZE,
+               pool=None):
+    """
+    Hashes local files in a pool of processes. Returns a dictionary of the
+    paths and their hex digests. Files that can't be read are missing.
+    paths: the list of file paths
+    algorithm: the name of the hash algorithm
+    processes: the number of processes (0: one per CPU)
+    chunk_size: the number of bytes that are read at once
+    pool: a multiprocessing pool that is used instead of a new pool
+    """
+    result = {}
+    if not paths:
+        return result
+    jobs = ((path, algorithm, chunk_size) for path in paths)
+    if pool != None:
+        for path, digest in pool.imap_unordered(hash_file, jobs, 16):
+            if digest != None:
+                result[path] = digest
+        return result
+
+    pool = multiprocessing.Pool(processes if processes > 0 else None)
+    try:
+        for path, digest in pool.imap_unordered(hash_file, jobs, 16):
+            if digest != None:
+                result[path] = digest
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return result
+
+
+def hash_remote(paths, client_ssh, algorithm="md5", commands=4):
+    """
+    Hashes files on the archive server. The paths are split into a few
+    groups, each of which is hashed by a single remote command, and the
+    commands run in parallel. Returns a dictionary of the paths and their
+    hex digests. Files that can't be read are missing.
+    paths: the list of absolute file paths on the archive
+    client_ssh: reference to the ssh client object
+    algorithm: the name of the hash algorithm
+    commands: the number of remote commands
+    """
+    if algorithm not in REMOTE_COMMANDS:
+        raise Exception("The hash algorithm '%s' isn't supported on the archive"\
+                        %algorithm)
+    result = {}
+    if not paths:
+        return result
+    commands = max(1, min(commands, len(paths)))
+    lock = threading.Lock()
+    errors = []
+
+    def run(group):
+        try:
+            stdin, stdout, stderr = client_ssh.exec_command(
+                "xargs -0 -r %s --"%REMOTE_COMMANDS[algorithm])
+            # the paths are written while the digests are read, otherwise
+            # the unread output blocks the remote command and its input
+            feeder = threading.Thread(target=_feed_paths, args=(stdin, group))
+            feeder.daemon = True
+            feeder.start()
+            digests = _parse_hash_output(stdout)
+            feeder.join()
+            err = stderr.read()
+            status = stdout.channel.recv_exit_status()
+            if status not in XARGS_PARTIAL:
+                raise Exception("The remote %s command failed (%i): %s"%\
+                                (REMOTE_COMMANDS[algorithm], status, err.rstrip()))
+            lock.acquire()
+            try:
+                result.update(digests)
+            finally:
+                lock.release()
+        except Exception, e:
+            errors.append(e)
+
+    threads = []
+    for i in range(commands):
+        thread = threading.Thread(target=run, args=(paths[i::commands],))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return result
+
+
+def verify(pairs, client_ssh, algorithm="md5", processes=0, commands=4,
+           chunk_size=CHUNK_SIZE, pool=None):
+    """
+    Compares the checksums of source files with those of their copies on
+    the archive. The local and the remote files are hashed at the same time.
+    Returns a dictionary with the number of verified files and the lists of
+    the mismatched and missing source files.
+    pairs: list of tuples of the local source path and the remote target path
+    client_ssh: reference to the ssh client object
+    algorithm: the name of the hash algorithm
+    processes: the number of local processes (0: one per CPU)
+    commands: the number of remote commands
+    chunk_size: the number of bytes that are read at once
+    pool: a multiprocessing pool that is used instead of a new pool
+    """
+    remote = {}
+    errors = []
+
+    def run_remote():
+        try:
+            remote.update(hash_remote([t for _, t in pairs], client_ssh,
+                                      algorithm, commands))
+        except Exception, e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run_remote)
+    thread.daemon = True
+    thread.start()
+    local = hash_local([s for s, _ in pairs], algorithm, processes, chunk_size,
+                       pool)
+    thread.join()
+    if errors:
+        raise errors[0]
+
+    result = {'verified': 0, 'mismatched': [], 'missing': []}
+    for source, target in pairs:
+        if (source not in local) or (target not in remote):
+            result['missing'].append(source)
+        elif local[source] != remote[target]:
+            result['mismatched'].append(source)
+        else:
+            result['verified'] += 1
+    return result
+
+
+def _feed_paths(stdin, paths):
+    """
+    Writes the NUL-delimited paths to the stdin of a remote command and
+    closes it.
+    stdin: the stdin of the remote command
+    paths: the list of paths
+    """
+    try:
+        stdin.write("\0".join(paths))
+    except (IOError, socket.error):
+        pass
+    finally:
+        stdin.channel.shutdown_write()
+
+
+def _parse_hash_output(stream):
+    """
+    Parses the output of the coreutils hash commands. Returns a dictionary
+    of the paths and their hex digests. Lines of paths with a backslash or
+    a newline start with a backslash and have these characters escaped.
+    stream: the output stream of the command
+    """
+    result = {}
+    for line in stream:
+        line = line.rstrip("\n")
+        if not line:
+            continue
+        escaped = line.startswith("\\")
+        if escaped:
+            line = line[1:]
+        digest, _, path = line.partition(" ")
+        path = path[1:]
+        if escaped:
+            path = path.replace("\\\\", "\0").replace("\\n", "\n")\
+                       .replace("\0", "\\")
+        result[path] = digest
+    return result
@@ -0,0 +1,81 @@
+import json
+import fnmatch
+import re
+from changeover.common.settings import Settings
+
+
+class ExcludeFilter(object):
+    """
+    Decides whether a file is excluded from archiving. The exclude regex of
+    the source settings and the exclude glob list of the rsync settings are
+    compiled into a single regex, and the decisions are cached per file name.
+    """
+    def __init__(self, regex="", globs=[], cache_size=100000):
+        """
+        Constructor of the exclude filter class
+        regex: a regex that is searched for in the file names
+        globs: a list of rsync style glob patterns for the file names
+        cache_size: maximum number of cached decisions
+        """
+        self.regex = regex
+        self.globs = list(globs)
+        patterns = ["(?:%s)"%regex] if regex else []
+        patterns.extend(["^(?:%s)\\Z"%_translate(g) for g in self.globs])
+        self._pattern = re.compile("|".join(patterns)) if patterns else None
+        self._cache = {}
+        self._cache_size = cache_size
+
+    def excluded(self, name):
+        """
+        Returns True if the file is excluded.
+        name: the name of the file (without the path)
+        """
+        if self._pattern == None:
+            return False
+        result = self._cache.get(name)
+        if result == None:
+            if len(self._cache) >= self._cache_size:
+                self._cache.clear()
+            result = self._pattern.search(name) != None
+            self._cache[name] = result
+        return result
+
+    def filter(self, names):
+        """
+        Returns the list of names that are not excluded.
+        names: a list of file names (without the path)
+        """
+        if self._pattern == None:
+            return list(names)
+        return [name for name in names if not self.excluded(name)]
+
+
+def _translate(glob):
+    """
+    Translates a glob pattern into a regex without the end anchor and flags
+    that fnmatch adds, so it can be combined with other patterns.
+    glob: the glob pattern
+    """
+    pattern = fnmatch.translate(glob)
+    if pattern.endswith("\\Z(?ms)"):
+        return pattern[:-len("\\Z(?ms)")]
+    if pattern.endswith("\\Z"):
+        return pattern[:-len("\\Z")]
+    return pattern
+
+
+_filters = {}
+
+def exclude_filter():
+    """
+    Returns the exclude filter for the current settings. The filter is
+    compiled once and shared by the watcher, rsync and the file listings.
+    """
+    conf = Settings()
+    key = (conf['source']['exclude'], conf['rsync']['exclude'])
+    result = _filters.get(key)
+    if result == None:
+        result = ExcludeFilter(key[0], json.loads(key[1]) if key[1] else [])
+        _filters.clear()
+        _filters[key] = result
+    return result
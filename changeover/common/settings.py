@@ -5,6 +5,54 @@ import ConfigParser
 from string import Template
 from common import saxslog
 
+# default values of the optional settings. They are used if the option is
+# missing from the configuration file.
+DEFAULTS = {'rsync': {'workers': "4",
+                      'max_files': "0",
+                      'max_bytes': "0",
+                      'max_latency': "0",
+                      'multiplex': "false",
+                      'control_path': "/tmp/changeover-%r@%h:%p",
+                      'sftp_max_files': "0",
+                      'sftp_max_bytes': "1048576",
+                      'tar_min_files': "0",
+                      'tar_max_size': "65536"},
+            'target': {'pool_size': "4",
+                       'keepalive': "30"},
+            'source': {'read_freq': "0",
+                       'max_queued_events': "0",
+                       'rescan_margin': "10"},
+            'reconcile': {'ledger': "",
+                          'workers': "4",
+                          'rate': "500",
+                          'margin': "300"},
+            'retry': {'journal': "",
+                      'min_backoff': "10",
+                      'max_backoff': "600",
+                      'interval': "5",
+                      'chunk': "1000"},
+            'compression': {'policy': "false",
+                            'link_speed': "1250",
+                            'incompressible': "",
+                            'sample_size': "65536"},
+            'changeover': {'checksum': "md5",
+                           'processes': "0",
+                           'commands': "4",
+                           'workers': "4",
+                           'verify_workers': "2",
+                           'chunk_files': "1000",
+                           'queue_size': "16",
+                           'plan_max_age': "900"},
+            'server': {'folder_ttl': "30",
+                       'watch_folders': "false",
+                       'pool_timeout': "30"},
+            'adaptive': {'enabled': "false",
+                         'latency': "10",
+                         'min_delay': "0",
+                         'max_delay': "30",
+                         'max_files': "10000"}}
+
+
 class ChangeoverParser(ConfigParser.ConfigParser):
     """
     Extends the ConfigParser by a method that returns a dictionary of the
@@ -20,7 +68,7 @@ class ChangeoverParser(ConfigParser.ConfigParser):
             for k, v in conf_dict[key].iteritems():
                 if v.lower() == "true":
                     conf_dict[key][k] = True
-                elif v.lower == "false":
+                elif v.lower() == "false":
                     conf_dict[key][k] = False
             conf_dict[key].pop('__name__', None)
         return conf_dict
@@ -42,6 +90,12 @@ def read(conf_path):
     """
     conf_parser = ChangeoverParser()
     conf_parser.read(conf_path)
+    for section, options in DEFAULTS.iteritems():
+        if not conf_parser.has_section(section):
+            conf_parser.add_section(section)
+        for key, value in options.iteritems():
+            if not conf_parser.has_option(section, key):
+                conf_parser.set(section, key, value)
     Settings().clear()
     Settings().update(conf_parser.to_dict())
 
@@ -87,21 +141,18 @@ def validate():
             logger.error("Key %s doesn't exist in the source folder settings!"%e)
         return False
 
-    # check if the target host is reachable (uses key pair authentication)
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    # check if the target host is reachable (uses key pair authentication).
+    # The connection is kept in the pool for the following remote operations.
+    from changeover.common import sshpool
+    pool = sshpool.pool()
     try:
-        client.connect(conf['target']['host'],
-                       username=conf['target']['user'],
-                       timeout=20)
-        client.close()
+        pool.release(pool.acquire())
         logger.info("Connection to the target host was successfully established")
     except (paramiko.SSHException, socket.error), e:
         if raven_client != None:
             raven_client.captureException()
         else:
             logger.error("Can't connect to target host: %s"%e)
-        client.close()
         return False
 
     # check if the statistics filename has either no or a valid list of
@@ -0,0 +1,194 @@
+import os
+import time
+import atexit
+import logging
+import tempfile
+import threading
+from subprocess import Popen, PIPE
+from changeover.common.settings import Settings
+
+logger = logging.getLogger(__name__)
+
+
+class SSHMaster(object):
+    """
+    Persistent OpenSSH master connection to the target host. The ssh
+    processes started by rsync attach to the master through its control
+    socket, so they don't need a handshake and authentication of their own.
+    If the master is not running, the ssh processes fall back to normal
+    connections and the master is restarted with an increasing backoff.
+    A master that is still listening on the control socket, e.g. left over
+    by a process that was killed, is used instead of starting a new one.
+    """
+    def __init__(self, host, user, control_path, timeout=20, min_backoff=5,
+                 max_backoff=300):
+        """
+        Constructor of the SSH master class
+        host: the name of the target host
+        user: the user name for the key pair authentication
+        control_path: the path of the control socket. Can contain the ssh
+                      tokens %r, %h and %p. Must not contain spaces.
+        timeout: time in seconds to wait for the master to come up
+        min_backoff: time in seconds before the first restart of a failed master
+        max_backoff: maximum time in seconds between restarts
+        """
+        self._host = host
+        self._user = user
+        self._control_path = control_path
+        self._timeout = timeout
+        self._min_backoff = min_backoff
+        self._max_backoff = max_backoff
+        self._backoff = 0
+        self._next_start = 0
+        self._proc = None
+        self._adopted = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the master connection and waits until it accepts sessions.
+        Returns True if the master is running.
+        """
+        self._lock.acquire()
+        try:
+            return self._start()
+        finally:
+            self._lock.release()
+
+    def stop(self):
+        """
+        Stops the master connection.
+        """
+        self._lock.acquire()
+        try:
+            if self._proc != None and self._proc.poll() == None:
+                self._control("exit")
+                try:
+                    self._proc.terminate()
+                except OSError:
+                    pass
+                self._proc.wait()
+                logger.info("Stopped the ssh master connection")
+            elif self._adopted and self._control("exit"):
+                logger.info("Stopped the ssh master connection")
+            self._proc = None
+            self._adopted = False
+        finally:
+            self._lock.release()
+
+    def rsh(self):
+        """
+        Returns the remote shell command for rsync. Restarts the master if
+        it has died and its backoff time has passed. The callers don't wait
+        for a restart that is in progress in another thread. The ssh
+        processes of rsync never become a master themselves.
+        """
+        if self._lock.acquire(False):
+            try:
+                if (self._proc == None or self._proc.poll() != None) and \
+                   (time.time() >= self._next_start):
+                    self._start()
+            finally:
+                self._lock.release()
+        return "ssh -o ControlMaster=no -o ControlPath=%s"%self._control_path
+
+    def _start(self):
+        """
+        Starts the master process. Has to be called with the lock held.
+        """
+        if self._proc != None and self._proc.poll() == None:
+            return True
+
+        # a second master couldn't bind the socket of a running one. The
+        # running master is checked again after the minimum backoff time.
+        if self._control("check"):
+            if not self._adopted:
+                logger.info("Using the running ssh master connection to '%s'"%\
+                            self._host)
+            self._proc = None
+            self._adopted = True
+            self._backoff = 0
+            self._next_start = time.time()+self._min_backoff
+            return True
+        self._adopted = False
+
+        # the messages of the master are only read if it exits
+        stderr = tempfile.TemporaryFile()
+        stdin = open(os.devnull)
+        stdout = open(os.devnull, 'w')
+        try:
+            self._proc = Popen(["ssh", "-M", "-N",
+                                "-o", "ControlPath=%s"%self._control_path,
+                                "-o", "ServerAliveInterval=30",
+                                "-o", "BatchMode=yes",
+                                "%s@%s"%(self._user, self._host)],
+                               stdin=stdin, stdout=stdout, stderr=stderr)
+        finally:
+            stdin.close()
+            stdout.close()
+        timeout = time.time()+self._timeout
+        while time.time() < timeout:
+            if self._proc.poll() != None:
+                stderr.seek(0)
+                logger.error("The ssh master connection exited: %s"%\
+                             stderr.read().rstrip())
+                break
+            if self._control("check"):
+                logger.info("Started the ssh master connection to '%s'"%self._host)
+                stderr.close()
+                self._backoff = 0
+                return True
+            time.sleep(0.1)
+        else:
+            logger.error("The ssh master connection didn't come up in %i s"%self._timeout)
+            try:
+                self._proc.terminate()
+            except OSError:
+                pass
+            self._proc.wait()
+        stderr.close()
+
+        # the sessions fall back to normal connections until the next try
+        self._backoff = min(max(2*self._backoff, self._min_backoff),
+                            self._max_backoff)
+        self._next_start = time.time()+self._backoff
+        logger.error("Retrying the ssh master connection in %i s"%self._backoff)
+        return False
+
+    def _control(self, command):
+        """
+        Sends a control command to the master. Returns True on success.
+        command: the control command, e.g. 'check' or 'exit'
+        """
+        proc = Popen(["ssh", "-O", command,
+                      "-o", "ControlPath=%s"%self._control_path,
+                      "%s@%s"%(self._user, self._host)],
+                     stdout=PIPE, stderr=PIPE)
+        proc.communicate()
+        return proc.returncode == 0
+
+
+_master = None
+
+def start():
+    """
+    Starts the master connection for the target host of the current settings
+    and stops it when the process exits.
+    """
+    global _master
+    conf = Settings()
+    if _master == None and conf['target']['host']:
+        _master = SSHMaster(conf['target']['host'], conf['target']['user'],
+                            conf['rsync']['control_path'])
+        _master.start()
+        atexit.register(_master.stop)
+
+
+def rsh():
+    """
+    Returns the remote shell command for rsync. Uses the master connection
+    if it has been started.
+    """
+    if _master != None:
+        return _master.rsh()
+    return "ssh"
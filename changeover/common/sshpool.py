@@ -0,0 +1,208 @@
+import time
+import socket
+import logging
+import threading
+import paramiko
+from changeover.common.settings import Settings
+
+logger = logging.getLogger(__name__)
+
+
+class SSHPool(object):
+    """
+    Pool of persistent SSH connections to the target host. Connections are
+    kept alive between uses, checked before they are handed out and
+    re-established if they have been dropped.
+    """
+    def __init__(self, host, user, size=4, keepalive=30, timeout=20):
+        """
+        Constructor of the SSH pool class
+        host: the name of the target host
+        user: the user name for the key pair authentication
+        size: the maximum number of connections
+        keepalive: interval in seconds of the keepalive packets (0: off)
+        timeout: timeout in seconds for establishing a connection
+        """
+        self._host = host
+        self._user = user
+        self._keepalive = keepalive
+        self._timeout = timeout
+        self._idle = []
+        self._sftp = {}
+        self._lock = threading.Lock()
+        self._size = max(1, size)
+        self._free = self._size
+        self._slots = threading.Condition(threading.Lock())
+
+    def acquire(self, timeout=None):
+        """
+        Returns a connected SSH client. Blocks if all connections are in use.
+        Raises paramiko.SSHException or socket.error if the connection can't
+        be established or no connection became free within the timeout.
+        timeout: maximum time in seconds to wait for a free connection
+                 (None: wait until one is free)
+        """
+        self._acquire_slot(timeout)
+        try:
+            while True:
+                self._lock.acquire()
+                try:
+                    client = self._idle.pop() if self._idle else None
+                finally:
+                    self._lock.release()
+                if client == None:
+                    return self._connect()
+                if self._healthy(client):
+                    return client
+                logger.info("Dropping stale connection to '%s'"%self._host)
+                self._close(client)
+        except:
+            self._release_slot()
+            raise
+
+    def release(self, client, broken=False):
+        """
+        Returns a client to the pool.
+        client: the client as returned by acquire()
+        broken: close the connection instead of keeping it, e.g. after an
+                SSH or socket error
+        """
+        try:
+            if broken:
+                self._close(client)
+            else:
+                self._lock.acquire()
+                try:
+                    self._idle.append(client)
+                finally:
+                    self._lock.release()
+        finally:
+            self._release_slot()
+
+    def close(self):
+        """
+        Closes all idle connections.
+        """
+        self._lock.acquire()
+        try:
+            idle = self._idle
+            self._idle = []
+        finally:
+            self._lock.release()
+        for client in idle:
+            self._close(client)
+
+    def sftp(self, client):
+        """
+        Returns the SFTP session of a client acquired from the pool. The
+        session is opened on first use and kept open with the connection.
+        client: the client as returned by acquire()
+        """
+        self._lock.acquire()
+        try:
+            session = self._sftp.get(client)
+        finally:
+            self._lock.release()
+        if (session == None) or session.get_channel().closed:
+            session = client.open_sftp()
+            self._lock.acquire()
+            try:
+                self._sftp[client] = session
+            finally:
+                self._lock.release()
+        return session
+
+    def _acquire_slot(self, timeout):
+        """
+        Takes one of the connection slots. Raises socket.error if no slot
+        became free within the timeout.
+        timeout: maximum time in seconds to wait (None: no limit)
+        """
+        deadline = time.time()+timeout if timeout != None else None
+        self._slots.acquire()
+        try:
+            while self._free == 0:
+                if deadline == None:
+                    self._slots.wait()
+                    continue
+                remaining = deadline-time.time()
+                if remaining <= 0:
+                    raise socket.error("All %i connections to '%s' are in use"%\
+                                       (self._size, self._host))
+                self._slots.wait(remaining)
+            self._free -= 1
+        finally:
+            self._slots.release()
+
+    def _release_slot(self):
+        """
+        Returns a connection slot and wakes up a waiting caller.
+        """
+        self._slots.acquire()
+        try:
+            self._free += 1
+            self._slots.notify()
+        finally:
+            self._slots.release()
+
+    def _close(self, client):
+        """
+        Closes a connection and its SFTP session.
+        client: the SSH client
+        """
+        self._lock.acquire()
+        try:
+            session = self._sftp.pop(client, None)
+        finally:
+            self._lock.release()
+        if session != None:
+            session.close()
+        client.close()
+
+    def _connect(self):
+        """
+        Establishes a new connection to the target host.
+        """
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            client.connect(self._host, username=self._user,
+                           timeout=self._timeout)
+        except:
+            client.close()
+            raise
+        if self._keepalive > 0:
+            client.get_transport().set_keepalive(self._keepalive)
+        logger.info("Connected to '%s'"%self._host)
+        return client
+
+    def _healthy(self, client):
+        """
+        Returns True if the connection of the client is still alive.
+        client: the SSH client
+        """
+        transport = client.get_transport()
+        return (transport != None) and transport.is_active()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def pool():
+    """
+    Returns the SSH pool for the target host of the current settings. The
+    pool is shared by all remote operations of the process.
+    """
+    conf = Settings()['target']
+    key = (conf['host'], conf['user'])
+    _pools_lock.acquire()
+    try:
+        result = _pools.get(key)
+        if result == None:
+            result = SSHPool(conf['host'], conf['user'],
+                             int(conf['pool_size']),
+                             float(conf['keepalive']))
+            _pools[key] = result
+    finally:
+        _pools_lock.release()
+    return result
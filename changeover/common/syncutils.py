@@ -1,25 +1,191 @@
 import os
 import re
+import sys
+import stat
+import time
+import socket
 import logging
+import tarfile
+import threading
+from pipes import quote
 from string import Template
 from subprocess import Popen, PIPE
+from changeover.common import filters
+from changeover.common.watchtree import list_subdirs
 from changeover.common.settings import Settings
 
 logger = logging.getLogger(__name__)
 
+# prefix of the rsync output lines that list the transferred items
+ITEM_PREFIX = "item: "
+
+# the permission, owner and group flags of the itemized changes (YXcstpog...)
+ITEM_ATTRS = slice(5, 8)
+
+# the rsync stats lines and the keys of their values in the result of
+# run_rsync(). Covers the wording of rsync 3.0 and 3.1.
+STATS_FIELDS = [("Number of files", 'files_total'),
+                ("Number of files transferred", 'files_transferred'),
+                ("Number of regular files transferred", 'files_transferred'),
+                ("Total file size", 'size_total'),
+                ("Total transferred file size", 'size_transferred'),
+                ("Literal data", 'literal_data'),
+                ("Matched data", 'matched_data'),
+                ("File list size", 'file_list_size'),
+                ("File list generation time", 'file_list_time'),
+                ("Total bytes sent", 'bytes_sent'),
+                ("Total bytes received", 'bytes_received')]
+STATS_REGEX = re.compile(r"^(?P<label>[A-Za-z ]+):\s+(?P<value>[\d,.]+)")
+SPEEDUP_REGEX = re.compile(r"speedup is (?P<value>[\d,.]+)")
+
+# rsync exit codes that only warn about files which vanished during the
+# transfer. The remaining files have been transferred.
+RSYNC_WARNINGS = [24]
+
+# size of the chunks in which files are written over SFTP
+SFTP_CHUNK_SIZE = 1048576
+
 
 def get_source_folders():
     """
     Returns a list of the source folders matching the template given in the
-    configuration file.
+    configuration file and their sub-directories.
+    """
+    return source_folders.get()
+
+
+def scan_source_folders():
+    """
+    Scans the watched directory for the source folders matching the template
+    given in the configuration file and their sub-directories. Only the
+    directories along the template are listed: literal path elements are
+    looked up directly, template parameters match any sub-directory. The
+    directory entries are typed by scandir, so the data files aren't stat'ed.
+    Like os.walk, symlinks to directories below the watched directory aren't
+    followed.
     """
     conf = Settings()
-    n_folders = len(conf['source']['folder_list'])
-    temp = Template(conf['source']['folder'])
-    regex = re.sub(temp.pattern, "(.*)", temp.template)
-    return [d[0] for d in os.walk(conf['source']['watch']) \
-            if (re.match(regex,d[0]) != None) and \
-               (len(d[0].split("/")) >= n_folders)]
+    watch = conf['source']['watch'].rstrip("/")+"/"
+    paths = ["/"]
+    for element in conf['source']['folder_list'][1:]:
+        found = []
+        for path in paths:
+            # symlinks are only followed above the watched directory
+            below_watch = (path.rstrip("/")+"/").startswith(watch)
+            if _is_template(element):
+                try:
+                    found.extend(os.path.join(path, name) for name in
+                                 list_subdirs(path, not below_watch))
+                except OSError:
+                    pass
+            else:
+                abs_dir = os.path.join(path, element)
+                if os.path.isdir(abs_dir) and \
+                   not (below_watch and os.path.islink(abs_dir)):
+                    found.append(abs_dir)
+        paths = [p for p in found if watch.startswith(p+"/") or p.startswith(watch)]
+
+    # add the sub-directories of the source folders
+    result = []
+    stack = [p for p in paths if p.startswith(watch)]
+    while stack:
+        path = stack.pop()
+        result.append(path)
+        try:
+            stack.extend(os.path.join(path, name) for name in
+                         list_subdirs(path, follow_symlinks=False))
+        except OSError, e:
+            logger.error("Couldn't list directory '%s': %s"%(path, e))
+    return sorted(result)
+
+
+def is_source_folder(path):
+    """
+    Returns True if the path is a source folder matching the template given
+    in the configuration file or one of its sub-directories. Paths through a
+    symlink below the watched directory are rejected, as they are by the scan.
+    path: the path of the directory
+    """
+    conf = Settings()
+    watch = conf['source']['watch'].rstrip("/")
+    if not path.startswith(watch+"/"):
+        return False
+    elements = path.rstrip("/").split("/")
+    src_path_list = conf['source']['folder_list']
+    if len(elements) < len(src_path_list):
+        return False
+    for element, src_element in zip(elements, src_path_list):
+        if not (element == src_element or (_is_template(src_element) and element)):
+            return False
+    curr_path = watch
+    for element in path[len(watch)+1:].rstrip("/").split("/"):
+        curr_path = os.path.join(curr_path, element)
+        if os.path.islink(curr_path):
+            return False
+    return True
+
+
+def _is_template(element):
+    """
+    Returns True if a path element of the source template is a parameter.
+    element: the path element
+    """
+    return element.startswith('${') and element.endswith('}')
+
+
+class SourceFolderCache(object):
+    """
+    The list of source folders. Once a watch tree reports its directories,
+    the list is kept up to date by the directory events of the tree. Until
+    then the source folders are scanned on every call.
+    """
+    def __init__(self):
+        """
+        Constructor of the source folder cache class
+        """
+        self._folders = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Returns the sorted list of source folders
+        """
+        self._lock.acquire()
+        try:
+            if self._folders != None:
+                return sorted(self._folders)
+        finally:
+            self._lock.release()
+        return scan_source_folders()
+
+    def update(self, added=[], removed=[]):
+        """
+        Adds and removes directories reported by a watch tree. The first
+        update has to report the whole tree.
+        added: the paths of the new directories
+        removed: the paths of the removed directories
+        """
+        self._lock.acquire()
+        try:
+            if self._folders == None:
+                self._folders = set()
+            self._folders.difference_update(removed)
+            self._folders.update(p for p in added if is_source_folder(p))
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        """
+        Stops using the reported directories, e.g. if the watch tree stopped
+        """
+        self._lock.acquire()
+        try:
+            self._folders = None
+        finally:
+            self._lock.release()
+
+
+source_folders = SourceFolderCache()
 
 
 def build_sync_paths(input_path):
@@ -75,134 +241,578 @@ def build_sync_paths(input_path):
     return source, target
 
 
+class RemoteDirCache(object):
+    """
+    The set of remote directories that are known to exist. It saves the
+    existence check for every batch that goes to a known directory.
+    """
+    def __init__(self):
+        """
+        Constructor of the remote directory cache class
+        """
+        self._dirs = set()
+        self._lock = threading.Lock()
+
+    def __contains__(self, remote_dir):
+        return remote_dir in self._dirs
+
+    def add(self, remote_dir):
+        """
+        Records a remote directory as existing
+        """
+        self._lock.acquire()
+        try:
+            self._dirs.add(remote_dir)
+        finally:
+            self._lock.release()
+
+    def discard(self, remote_dir):
+        """
+        Removes a remote directory from the cache, e.g. after an error
+        """
+        self._lock.acquire()
+        try:
+            self._dirs.discard(remote_dir)
+        finally:
+            self._lock.release()
+
+
+remote_dirs = RemoteDirCache()
+
+
 def mkdir_remote(remote_dir, client_ssh):
     """
-    Make the remote directory by creating each subdirectory separately.
+    Make the remote directory including all missing parent directories.
     Change the permission of each newly created sub-directory to the target
-    owner/group permission. 
+    owner/group permission. The whole chain is checked and created by a
+    single remote command.
     remote_dir: the remote directory that should be created
     client_ssh: reference to the ssh client object
     """
-    remote_list = remote_dir.split("/")
-    cmd  = "[ -d ${dir} ] || (${sudo} mkdir ${dir}"
-    cmd += " && ${sudo} chown -R ${user}:${group} ${dir}"
-    cmd += " && ${sudo} chmod -R ${chmod} ${dir})"
+    cmd  = "for d in ${dirs}; do [ -d \"$$d\" ] && continue;"
+    cmd += " if ${sudo} mkdir \"$$d\" 2>/dev/null; then"
+    cmd += " ${sudo} chown ${user}:${group} \"$$d\""
+    cmd += " && ${sudo} chmod ${chmod} \"$$d\" || exit 1;"
+    # another worker may have created the directory in the meantime,
+    # otherwise mkdir is run again to report the error
+    cmd += " elif [ ! -d \"$$d\" ]; then ${sudo} mkdir \"$$d\"; exit 1; fi; done"
     cmd_dict = {'sudo' : "sudo" if Settings()['target']['sudo'] else "",
-                'dir'  : "",
+                'dirs' : "",
                 'user' : Settings()['target']['owner'],
                 'group': Settings()['target']['group'],
                 'chmod': Settings()['target']['permission']
                }
 
-    # loop over all subdirectories. If the subdirectory doesn't exist, create it
+    # build the list of all subdirectories
+    dirs = []
     total_dir = "/"
-    for curr_dir in remote_list:
-        if not curr_dir:
-            continue
+    for curr_dir in remote_dir.split("/"):
+        if curr_dir:
+            total_dir = os.path.join(total_dir, curr_dir)
+            dirs.append(quote(total_dir))
+    if not dirs:
+        return
+    cmd_dict['dirs'] = " ".join(dirs)
 
-        # build the command line
-        total_dir = os.path.join(total_dir, curr_dir)
-        cmd_dict['dir'] = total_dir
-
-        # execute the ssh command
-        _, _, stderr = client_ssh.exec_command(Template(cmd).substitute(cmd_dict))
-        client_error = stderr.read()
-        if client_error:
-            raise Exception("Couldn't create target directory: '%s'"\
-                             %client_error.rstrip())
+    # execute the ssh command
+    _, _, stderr = client_ssh.exec_command(Template(cmd).substitute(cmd_dict))
+    client_error = stderr.read()
+    if client_error:
+        raise Exception("Couldn't create target directory: '%s'"\
+                         %client_error.rstrip())
 
 
-def run_rsync(source, target, file_list, client_ssh, options="", exclude_list=[]):
+def run_rsync(source, target, file_list, client_ssh, options="", exclude_list=[],
+              rsh="ssh"):
     """
     Run rsync in order to copy the files from the detector server to the
     archive server. The process is done in three steps:
     1) Change the owner of the target directory to the user rsync uses to
        login to the archive server
     2) Call rsync to copy the data from the detector server to the archive
-    3) Change the owner of the target directory back to the owner and group
-       specified in the configuration file
+    3) Change the owner of the target directory and of the files rsync
+       transferred back to the owner and group specified in the
+       configuration file
     source: the source path on the detector server
     target: the target path on the archive server
     file_list: the list of files that should be rsynced
     client_ssh: reference to the ssh client object
     options: additional options that should be given to rsync
-    Returns a dictionary with information collected from rsync
+    exclude_list: list of glob patterns rsync should exclude
+    rsh: the remote shell command rsync uses to connect to the archive
+    Returns a dictionary with information collected from rsync: the transfer
+    method, the stats (see STATS_FIELDS), the speedup, the elapsed time of rsync in seconds,
+    the itemized items as (name, changes, size) tuples, the names of the
+    items that were transferred or had their permissions or owner changed,
+    the return code and the warnings rsync printed.
+    Raises an exception if rsync failed.
     """
     conf = Settings()['target']
-    cmd =  "${sudo} chown ${options} ${user}:${group} ${target}"
-    cmd += " && ${sudo} chmod ${options} ${chmod} ${target}"
-    cmd_dict = {'sudo'   : "sudo" if conf['sudo']==True else "",
-                'options': "",
-                'target' : "",
-                'user'   : "",
-                'group'  : "",
-                'chmod'  : ""
-               }
 
     # pre-chown: change the owner of the target dir to the login user
-    cmd_dict['user']   = conf['user']
-    cmd_dict['group']  = conf['user']
-    cmd_dict['target'] = target
-    cmd_dict['chmod']  = "755"
-    _, _, stderr = client_ssh.exec_command(Template(cmd).substitute(cmd_dict))
-    client_error = stderr.read()
-    if client_error:
-        raise Exception("Couldn't change the ownership of the target directory: '%s'"\
-                        %client_error.rstrip())
+    _pre_chown(target, client_ssh)
 
-    # rsync: call rsync
+    # rsync: call rsync. Without a target host the target is a local
+    # directory, e.g. for benchmarks. Each transferred item is listed with
+    # its itemized changes and size.
     cmd_rsync = ["rsync", options]
     cmd_rsync.append("--files-from=-")
     for exclude in exclude_list:
         cmd_rsync.append("--exclude=%s"%exclude)
-    cmd_rsync.extend(["--stats", "-e", "ssh",
-                      source, "%s@%s:%s"%(conf['user'], conf['host'], target)])
+    if conf['host']:
+        destination = "%s@%s:%s"%(conf['user'], conf['host'], target)
+    else:
+        destination = target
+    cmd_rsync.extend(["--stats", "--out-format=%s%%i %%l %%n"%ITEM_PREFIX,
+                      "-e", rsh, source, destination])
+    result_dict = {'source': source,
+                   'target': target,
+                   'method': "rsync",
+                   'files_total': 0,
+                   'files_transferred': 0,
+                   'size_total': 0,
+                   'size_transferred': 0,
+                   'literal_data': 0,
+                   'matched_data': 0,
+                   'speedup': 0.0,
+                   'items': [],
+                   'transferred': [],
+                   'warnings': []}
+
+    # the file list is fed and stderr is drained by threads, while stdout
+    # is parsed line by line as rsync writes it
+    start_time = time.time()
     proc = Popen(cmd_rsync, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = proc.communicate(input='\n'.join(file_list))
-    if stderr:
-        raise Exception("Error while calling rsync: '%s'"%stderr)
+    stderr_lines = []
+    feeder = threading.Thread(target=_feed_lines, args=(proc.stdin, file_list))
+    drain = threading.Thread(target=_drain_lines, args=(proc.stderr, stderr_lines))
+    feeder.daemon = True
+    drain.daemon = True
+    feeder.start()
+    drain.start()
+    for line in iter(proc.stdout.readline, ""):
+        _parse_rsync_line(line.rstrip("\n"), result_dict)
+    proc.wait()
+    feeder.join()
+    drain.join()
+    result_dict['elapsed'] = time.time()-start_time
+    result_dict['returncode'] = proc.returncode
+    result_dict['warnings'] = stderr_lines
+    if proc.returncode != 0 and proc.returncode not in RSYNC_WARNINGS:
+        # the items rsync copied before the error aren't listed again by
+        # the retry, so their owner is changed back now
+        if result_dict['transferred']:
+            try:
+                _post_chown(target, result_dict['transferred'], client_ssh)
+            except Exception, e:
+                logger.error(e)
+        raise Exception("Error while calling rsync (code %i): '%s'"%\
+                        (proc.returncode, "\n".join(stderr_lines)))
+    if stderr_lines:
+        logger.warning("rsync reported warnings: %s"%"; ".join(stderr_lines))
+
+    # post-chown: change the owner of the target dir and of the transferred
+    # items to the target user
+    _post_chown(target, result_dict['transferred'], client_ssh)
 
-    # parse output and collect the stats information
-    out_list = stdout.split("\n")
+    # return a dictionary with the result of rsync
+    return result_dict
+
+
+def run_sftp(source, target, file_list, client_ssh, client_sftp, exclude_list=[]):
+    """
+    Copy the files from the detector server to the archive server over SFTP.
+    Saves starting rsync and a new ssh process for batches of a few small
+    files. The steps are the same as for run_rsync(). Each file is written
+    with pipelined writes to a temporary name, gets the modification time of
+    the source file and is renamed in place. Files with the same size and
+    modification time on the archive are skipped, like rsync does, but
+    their owner is changed if they still belong to the login user.
+    source: the source path on the detector server
+    target: the target path on the archive server
+    file_list: the list of files that should be copied
+    client_ssh: reference to the ssh client object
+    client_sftp: reference to the sftp client of the ssh connection
+    exclude_list: list of glob patterns that should be excluded
+    Returns a dictionary with the same information as run_rsync()
+    """
+    exclude = filters.ExcludeFilter("", exclude_list)
     result_dict = {'source': source,
-                   'target': target}
+                   'target': target,
+                   'method': "sftp",
+                   'files_total': 0,
+                   'files_transferred': 0,
+                   'size_total': 0,
+                   'size_transferred': 0,
+                   'literal_data': 0,
+                   'matched_data': 0,
+                   'speedup': 1.0,
+                   'items': [],
+                   'transferred': [],
+                   'warnings': [],
+                   'returncode': 0}
+
+    # pre-chown: change the owner of the target dir to the login user
+    _pre_chown(target, client_ssh)
+
+    start_time = time.time()
+    login_uid = None
     try:
-        for line in out_list:
-            if not line:
+        for name in exclude.filter(file_list):
+            src_path = os.path.join(source, name)
+            dst_path = os.path.join(target, name)
+            try:
+                st = os.stat(src_path)
+            except OSError, e:
+                result_dict['warnings'].append("Couldn't read '%s': %s"%(src_path, e))
+                continue
+            if not stat.S_ISREG(st.st_mode):
                 continue
-            tokens = line.split()
-            if line.startswith("Number of files:"):
-                result_dict['files_total'] = int(tokens[3].strip())-1
-            elif line.startswith("Number of files transferred:"):
-                result_dict['files_transferred'] = int(tokens[4].strip())
-            elif line.startswith("Total file size:"):
-                result_dict['size_total'] = int(tokens[3].strip())
-            elif line.startswith("Total transferred file size:"):
-                result_dict['size_transferred'] = int(tokens[4].strip())
+            result_dict['files_total'] += 1
+            result_dict['size_total'] += st.st_size
+
+            # quick check: skip files that haven't changed
+            changes = ">f+++++++++"
+            try:
+                dst_st = client_sftp.stat(dst_path)
+                if (dst_st.st_size == st.st_size) and \
+                   (int(dst_st.st_mtime) == int(st.st_mtime)):
+                    # a file copied by a failed batch may still have the
+                    # owner and permissions of the login user
+                    if login_uid == None:
+                        login_uid = client_sftp.stat(target).st_uid
+                    if _needs_chown(dst_st, login_uid):
+                        result_dict['transferred'].append(name)
+                    continue
+                changes = ">f.st......"
+            except IOError:
+                pass
+
+            # write the file to a temporary name and rename it in place
+            tmp_path = os.path.join(target, ".%s.changeover"%name)
+            try:
+                src_file = open(src_path, 'rb')
+            except IOError, e:
+                result_dict['warnings'].append("Couldn't read '%s': %s"%(src_path, e))
+                continue
+            try:
+                dst_file = client_sftp.open(tmp_path, 'wb')
+                try:
+                    dst_file.set_pipelined(True)
+                    while True:
+                        data = src_file.read(SFTP_CHUNK_SIZE)
+                        if not data:
+                            break
+                        dst_file.write(data)
+                finally:
+                    dst_file.close()
+                client_sftp.utime(tmp_path, (st.st_atime, st.st_mtime))
+                client_sftp.posix_rename(tmp_path, dst_path)
+            except:
+                # don't leave the partial file on the archive
+                exc_info = sys.exc_info()
+                try:
+                    client_sftp.remove(tmp_path)
+                except Exception:
+                    pass
+                raise exc_info[0], exc_info[1], exc_info[2]
+            finally:
+                src_file.close()
+
+            result_dict['files_transferred'] += 1
+            result_dict['size_transferred'] += st.st_size
+            result_dict['items'].append((name, changes, st.st_size))
+            result_dict['transferred'].append(name)
     except:
-        logger.error("Couldn't read the rsync stats: %s"%stdout)
-
-    # post-chown: change the owner of the target dir + files to the target user
-    cmd_dict['user']   = conf['owner']
-    cmd_dict['group']  = conf['group']
-    cmd_dict['options'] = "-R"
-    #cmd_dict['target'] = " ".join(os.path.join(target,f) for f in file_list)
-    cmd_dict['chmod']  = conf['permission']
-
-    #for f in file_list:
-    #    cmd_dict['target'] = os.path.join(target,f)
-    #    _, _, stderr = client_ssh.exec_command(Template(cmd).substitute(cmd_dict))
-    #    client_error = stderr.read()
-    #    if client_error:
-    #        raise Exception("Couldn't change the ownership of the target file: '%s'"\
-    #                        %client_error.rstrip())
-
-    cmd_dict['target'] = target
+        # the files copied so far are skipped by the retry, so their owner
+        # is changed back now
+        exc_info = sys.exc_info()
+        if result_dict['transferred']:
+            try:
+                _post_chown(target, result_dict['transferred'], client_ssh)
+            except Exception, e:
+                logger.error(e)
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+    result_dict['elapsed'] = time.time()-start_time
+    result_dict['literal_data'] = result_dict['size_transferred']
+    if result_dict['warnings']:
+        logger.warning("SFTP transfer reported warnings: %s"%\
+                       "; ".join(result_dict['warnings']))
+
+    # post-chown: change the owner of the target dir and of the transferred
+    # items to the target user
+    _post_chown(target, result_dict['transferred'], client_ssh)
+    return result_dict
+
+
+def run_tar(source, target, file_list, client_ssh, compress=False,
+            exclude_list=[]):
+    """
+    Copy the files from the detector server to the archive server as a
+    single tar stream, which is unpacked on the archive. Saves the per-file
+    overhead of rsync for batches of many tiny files. The steps are the same
+    as for run_rsync(), followed by a manifest check that compares the size
+    and modification time of the unpacked files with the source files.
+    source: the source path on the detector server
+    target: the target path on the archive server
+    file_list: the list of files that should be copied
+    client_ssh: reference to the ssh client object
+    compress: compress the tar stream with gzip
+    exclude_list: list of glob patterns that should be excluded
+    Returns a dictionary with the same information as run_rsync()
+    """
+    exclude = filters.ExcludeFilter("", exclude_list)
+    result_dict = {'source': source,
+                   'target': target,
+                   'method': "tar",
+                   'files_total': 0,
+                   'files_transferred': 0,
+                   'size_total': 0,
+                   'size_transferred': 0,
+                   'literal_data': 0,
+                   'matched_data': 0,
+                   'speedup': 1.0,
+                   'items': [],
+                   'transferred': [],
+                   'warnings': [],
+                   'returncode': 0}
+
+    # pre-chown: change the owner of the target dir to the login user
+    _pre_chown(target, client_ssh)
+
+    # stream the files into tar on the archive
+    start_time = time.time()
+    cmd = "cd %s && tar -x%sf -"%(quote(target), "z" if compress else "")
+    stdin, _, stderr = client_ssh.exec_command(cmd)
+    manifest = {}
+    archive = tarfile.open(fileobj=stdin, mode="w|gz" if compress else "w|")
+    try:
+        for name in exclude.filter(file_list):
+            src_path = os.path.join(source, name)
+            try:
+                info = archive.gettarinfo(src_path, arcname=name)
+                if not info.isreg():
+                    continue
+                src_file = open(src_path, 'rb')
+            except (OSError, IOError), e:
+                result_dict['warnings'].append("Couldn't read '%s': %s"%(src_path, e))
+                continue
+            try:
+                archive.addfile(info, src_file)
+            finally:
+                src_file.close()
+            manifest[name] = (info.size, int(info.mtime))
+            result_dict['items'].append((name, ">f+++++++++", info.size))
+            result_dict['transferred'].append(name)
+    finally:
+        archive.close()
+        stdin.channel.shutdown_write()
+    client_error = stderr.read()
+    if client_error or stdin.channel.recv_exit_status() != 0:
+        raise Exception("Error while unpacking the tar stream: '%s'"%\
+                        client_error.rstrip())
+    result_dict['elapsed'] = time.time()-start_time
+    result_dict['files_total'] = len(manifest)
+    result_dict['files_transferred'] = len(manifest)
+    result_dict['size_total'] = sum(size for size, _ in manifest.itervalues())
+    result_dict['size_transferred'] = result_dict['size_total']
+    result_dict['literal_data'] = result_dict['size_total']
+    if result_dict['warnings']:
+        logger.warning("tar transfer reported warnings: %s"%\
+                       "; ".join(result_dict['warnings']))
+
+    # manifest check: compare the unpacked files with the source files
+    cmd = "cd %s && xargs -0 -r stat --printf='%%s %%Y %%n\\0' --"%quote(target)
+    stdin, stdout, stderr = client_ssh.exec_command(cmd)
+    feeder = threading.Thread(target=_feed_names,
+                              args=(stdin, result_dict['transferred']))
+    feeder.daemon = True
+    feeder.start()
+    output = stdout.read()
+    feeder.join()
+    for entry in output.split("\0"):
+        if entry:
+            size, mtime, name = entry.split(" ", 2)
+            if manifest.pop(name, None) == (int(size), int(mtime)):
+                continue
+            raise Exception("The unpacked file '%s' doesn't match the source"%\
+                            os.path.join(target, name))
+    if manifest:
+        raise Exception("%i files are missing after unpacking, e.g. '%s'"%\
+                        (len(manifest), os.path.join(target, manifest.keys()[0])))
+
+    # post-chown: change the owner of the target dir and of the transferred
+    # items to the target user
+    _post_chown(target, result_dict['transferred'], client_ssh)
+    return result_dict
+
+
+def _pre_chown(target, client_ssh):
+    """
+    Changes the owner of the target directory to the login user, so the
+    files can be written to it.
+    target: the target path on the archive server
+    client_ssh: reference to the ssh client object
+    """
+    conf = Settings()['target']
+    cmd =  "${sudo} chown ${user}:${group} ${target}"
+    cmd += " && ${sudo} chmod ${chmod} ${target}"
+    cmd_dict = {'sudo'   : "sudo" if conf['sudo']==True else "",
+                'target' : quote(target),
+                'user'   : conf['user'],
+                'group'  : conf['user'],
+                'chmod'  : "755"
+               }
     _, _, stderr = client_ssh.exec_command(Template(cmd).substitute(cmd_dict))
     client_error = stderr.read()
     if client_error:
         raise Exception("Couldn't change the ownership of the target directory: '%s'"\
                         %client_error.rstrip())
 
-    # return a dictionary with the result of rsync
-    return result_dict
+
+def _post_chown(target, names, client_ssh):
+    """
+    Changes the owner of the target directory and of the transferred items
+    to the owner and group specified in the configuration file. The item
+    names are streamed to xargs, which runs as few chown/chmod commands as
+    the argument limit allows.
+    target: the target path on the archive server
+    names: the names of the transferred items relative to the target
+    client_ssh: reference to the ssh client object
+    """
+    conf = Settings()['target']
+    cmd  = "cd ${target} && ${sudo} chown ${user}:${group} ."
+    cmd += " && ${sudo} chmod ${chmod} ."
+    cmd += " && xargs -0 -r sh -c '${sudo} chown ${user}:${group} -- \"$$@\""
+    cmd += " && ${sudo} chmod ${chmod} -- \"$$@\"' sh"
+    cmd_dict = {'sudo'   : "sudo" if conf['sudo']==True else "",
+                'target' : quote(target),
+                'user'   : conf['owner'],
+                'group'  : conf['group'],
+                'chmod'  : conf['permission']
+               }
+    stdin, _, stderr = client_ssh.exec_command(Template(cmd).substitute(cmd_dict))
+    feeder = threading.Thread(target=_feed_names, args=(stdin, names))
+    feeder.daemon = True
+    feeder.start()
+    client_error = stderr.read()
+    feeder.join()
+    if client_error:
+        raise Exception("Couldn't change the ownership of the transferred files: '%s'"\
+                        %client_error.rstrip())
+
+
+def _needs_chown(dst_st, login_uid):
+    """
+    Returns True if a file on the archive still has the owner or the
+    permissions the login user wrote it with, instead of the ones specified
+    in the configuration file.
+    dst_st: the SFTP attributes of the file
+    login_uid: the user id of the login user on the archive
+    """
+    conf = Settings()['target']
+    if (dst_st.st_uid == login_uid) and (conf['owner'] != conf['user']):
+        return True
+    try:
+        return stat.S_IMODE(dst_st.st_mode) != int(conf['permission'], 8)
+    except ValueError:
+        return False
+
+def _feed_lines(stream, lines):
+    """
+    Writes lines to a stream and closes it. Stops if the reading process
+    has exited.
+    stream: the stream, e.g. the stdin of a process
+    lines: the lines without newline characters
+    """
+    try:
+        for line in lines:
+            stream.write(line+"\n")
+    except IOError:
+        pass
+    finally:
+        try:
+            stream.close()
+        except IOError:
+            pass
+
+
+def _feed_names(stdin, names):
+    """
+    Writes the NUL-delimited names to the stdin of a remote command and
+    closes it. Runs in its own thread, so the command never blocks on a full
+    output channel while the names are written.
+    stdin: the stdin of the remote command
+    names: the list of names
+    """
+    try:
+        stdin.write("\0".join(names))
+    except (IOError, socket.error):
+        pass
+    finally:
+        stdin.channel.shutdown_write()
+
+
+def _drain_lines(stream, lines):
+    """
+    Reads a stream until it is closed and appends the non-empty lines to a
+    list.
+    stream: the stream, e.g. the stderr of a process
+    lines: the list the lines are appended to
+    """
+    for line in iter(stream.readline, ""):
+        line = line.rstrip()
+        if line:
+            lines.append(line)
+    stream.close()
+
+
+def _parse_rsync_line(line, result_dict):
+    """
+    Parses a line of the rsync output into the result dictionary. The line
+    is either an itemized transfer, a stats line or the speedup summary.
+    line: the line without the newline character
+    result_dict: the result dictionary of run_rsync()
+    """
+    if line.startswith(ITEM_PREFIX):
+        try:
+            changes, size, name = line[len(ITEM_PREFIX):].split(" ", 2)
+        except ValueError:
+            logger.error("Couldn't read the rsync item: %s"%line)
+            return
+        name = name.rstrip("/")
+        result_dict['items'].append((name, changes,
+                                     int(size) if size.isdigit() else 0))
+        # rsync also sets the permissions and owner of the source on items
+        # it doesn't transfer, these have to be changed back as well
+        if (not changes.startswith(".")) or \
+           any(c in "pog" for c in changes[ITEM_ATTRS]):
+            result_dict['transferred'].append(name)
+        return
+
+    match = STATS_REGEX.match(line)
+    if match != None:
+        label = match.group('label').strip()
+        for field, key in STATS_FIELDS:
+            if label == field:
+                try:
+                    value = match.group('value').replace(",", "")
+                    if key == 'files_total':
+                        # don't count the top directory
+                        result_dict[key] = max(0, int(value)-1)
+                    elif key == 'file_list_time':
+                        result_dict[key] = float(value)
+                    else:
+                        result_dict[key] = int(value)
+                except ValueError:
+                    logger.error("Couldn't read the rsync stats: %s"%line)
+                break
+        return
+
+    match = SPEEDUP_REGEX.search(line)
+    if match != None:
+        try:
+            result_dict['speedup'] = float(match.group('value').replace(",", ""))
+        except ValueError:
+            logger.error("Couldn't read the rsync speedup: %s"%line)
@@ -1,58 +1,403 @@
 import os
-import re
+import time
+import stat
+import heapq
+import Queue
+import itertools
 import logging
 import pyinotify
 import threading
+from collections import deque, OrderedDict
+from changeover.common import filters
 
-logger  = logging.getLogger(__name__)
-fh_lock = threading.Lock()
+# use the fast directory scan if it is available (Python >= 3.5 or the
+# scandir backport), otherwise fall back to os.listdir and os.path.isdir
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
-class FileHandlerThread(threading.Thread):
+logger = logging.getLogger(__name__)
+
+WATCH_MASK = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | \
+             pyinotify.IN_DELETE | pyinotify.IN_MOVED_TO | \
+             pyinotify.IN_MOVED_FROM
+
+
+def list_subdirs(path, follow_symlinks=True):
+    """
+    Returns the names of the sub-directories of the specified path. Uses the
+    file type information of the directory entries if scandir is available
+    in order to avoid a stat call per entry.
+    path: the directory that should be listed
+    follow_symlinks: if False, symlinks to directories are left out
+    """
+    if scandir != None:
+        return [entry.name for entry in scandir(path) \
+                if entry.is_dir(follow_symlinks=follow_symlinks)]
+    else:
+        return [name for name in os.listdir(path) \
+                if os.path.isdir(os.path.join(path, name)) and \
+                   (follow_symlinks or not os.path.islink(os.path.join(path, name)))]
+
+
+class WorkerPool(object):
+    """
+    A fixed number of worker threads that call the file handler process for
+    the batches that are ready to be synced. Batches for different targets
+    are processed in parallel, while batches for the same target are
+    processed one after the other in the order they were submitted.
+    """
+    def __init__(self, file_handler, workers=4):
+        """
+        Constructor of the worker pool class
+        file_handler: reference to a file handler object
+        workers: the maximum number of batches that are processed concurrently
+        """
+        self._file_handler = file_handler
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._active = set()
+        self._waiting = {}
+        self._threads = []
+        for i in range(max(1, workers)):
+            thread = threading.Thread(target=self._work,
+                                      name="FileHandlerWorker-%i"%i)
+            thread.daemon = True
+            self._threads.append(thread)
+
+    def start(self):
+        """
+        Starts the worker threads.
+        """
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """
+        Stops the worker threads after the queued batches have been processed.
+        """
+        for thread in self._threads:
+            self._queue.put(None)
+
+    def submit(self, path, file_list):
+        """
+        Queues a batch for processing. If a batch for the same target is
+        being processed, the batch waits until it is finished.
+        path: the path of the directory the files are located in
+        file_list: the names of the files that should be processed
+        """
+        key = self._file_handler.target(path)
+        self._lock.acquire()
+        try:
+            if key in self._active:
+                self._waiting.setdefault(key, deque()).append((path, file_list))
+                return
+            self._active.add(key)
+        finally:
+            self._lock.release()
+        self._queue.put((key, path, file_list))
+
+    def _next(self, key):
+        """
+        Returns the next waiting batch for the target or None if there is no
+        waiting batch, in which case the target is released. Waiting batches
+        of the same directory are merged into one batch.
+        key: the target of the finished batch
+        """
+        self._lock.acquire()
+        try:
+            waiting = self._waiting.get(key)
+            if not waiting:
+                self._active.discard(key)
+                return None
+            path, file_list = waiting.popleft()
+            batch = OrderedDict.fromkeys(file_list)
+            while waiting and waiting[0][0] == path:
+                batch.update(OrderedDict.fromkeys(waiting.popleft()[1]))
+            if not waiting:
+                del self._waiting[key]
+            return (key, path, batch.keys())
+        finally:
+            self._lock.release()
+
+    def _work(self):
+        """
+        The main method of a worker thread. Processes batches until it
+        receives the stop marker.
+        """
+        while True:
+            batch = self._queue.get()
+            if batch == None:
+                return
+
+            # the worker keeps the target until no batch is waiting for it
+            while batch != None:
+                key, path, file_list = batch
+                try:
+                    self._file_handler.process(path, file_list)
+                except Exception, e:
+                    logger.error("File handler failed for '%s': %s"%(path, e))
+                batch = self._next(key)
+
+
+class DirectoryQueue(object):
+    """
+    The pending files of a single directory. Files are appended by the
+    notification thread and the threads that add missed files, e.g. the
+    reconciliation, and taken by the scheduler thread. Appending and taking
+    are atomic deque operations and only the appending threads share a lock,
+    so adding files never waits for a batch being taken.
+    """
+    __slots__ = ('path', 'scheduled', 'flushing', 'generation', 'first',
+                 'last', 'delay', 'max_files', '_files', '_added_bytes',
+                 '_taken_bytes', '_put_lock')
+
+    def __init__(self, path):
+        """
+        Constructor of the directory queue class
+        path: the path of the directory
+        """
+        self.path = path
+        self.scheduled = False
+        self.flushing = False
+        self.generation = 0
+        self.first = 0
+        self.last = 0
+        self.delay = 0
+        self.max_files = 0
+        self._files = deque()
+        self._added_bytes = 0
+        self._taken_bytes = 0
+        self._put_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._files)
+
+    def pending_bytes(self):
+        """
+        Returns the number of bytes of the pending files. Rewritten files
+        are counted each time they were added.
+        """
+        return self._added_bytes - self._taken_bytes
+
+    def put(self, name, size=0):
+        """
+        Appends a file to the queue.
+        name: the name of the file
+        size: the size of the file in bytes
+        """
+        self._put_lock.acquire()
+        try:
+            self._files.append((name, size))
+            self._added_bytes += size
+        finally:
+            self._put_lock.release()
+
+    def take(self, max_files=0, max_bytes=0):
+        """
+        Removes the pending files from the queue and returns their names as
+        a list. Files that were added several times are returned only once,
+        in the order they were first added.
+        max_files: stop after this number of distinct files (0: no limit)
+        max_bytes: stop after this number of bytes (0: no limit)
+        """
+        batch = OrderedDict()
+        taken_bytes = 0
+        try:
+            while ((not max_files) or (len(batch) < max_files)) and \
+                  ((not max_bytes) or (taken_bytes < max_bytes)):
+                name, size = self._files.popleft()
+                batch[name] = size
+                taken_bytes += size
+        except IndexError:
+            pass
+        self._taken_bytes += taken_bytes
+        return batch.keys()
+
+
+class BatchScheduler(threading.Thread):
     """
-    Thread class that waits the delay time and then calls the file handler process
+    Thread class that owns the pending per-directory batches. Each directory
+    gets a deadline when its first file arrives, and the batch is handed to
+    the worker pool once the deadline has passed. The deadlines are kept in a
+    heap, so a single thread serves all watched directories.
+    A batch is handed out early if it reaches the maximum number of files or
+    bytes. If a maximum latency is set, the delay is the time without new
+    files in the directory, but the batch is never held back longer than the
+    maximum latency after its first file.
+    The file handler can override the delay and the maximum number of files
+    for each batch through its batch_window() method.
     """
-    def __init__(self, delay, file_list, file_handler, path):
+    def __init__(self, file_handler, delay=0, workers=4, max_files=0,
+                 max_bytes=0, max_latency=0):
         """
-        Constructor of the file handler thread class
-        delay: time in seconds the thread should wait
-        file_list: reference to the list of triggered files. Only the names
-                   of the files as the path is given by the node
+        Constructor of the batch scheduler class
         file_handler: reference to a file handler object
-        path: The path of the node the thread was started from
+        delay: time in seconds to aggregate together several events
+        workers: the maximum number of batches that are processed concurrently
+        max_files: maximum number of files in a batch (0: no limit)
+        max_bytes: maximum number of bytes in a batch (0: no limit)
+        max_latency: maximum time in seconds the first file of a batch waits
+                     (0: the batch is handed out after the delay time)
         """
-        super(FileHandlerThread, self).__init__()
+        super(BatchScheduler, self).__init__(name="BatchScheduler")
+        self.daemon = True
         self._delay = delay
-        self._file_list = file_list
+        self._max_files = max_files
+        self._max_bytes = max_bytes
+        self._max_latency = max_latency
         self._file_handler = file_handler
+        self._pool = WorkerPool(file_handler, workers)
+        self._queues = {}
+        self._deadlines = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
         self._stop = threading.Event()
-        self._path = path
+
+    def add(self, path, name, size=0):
+        """
+        Adds a file to the pending batch of its directory. Schedules the
+        batch if it is the first file of the batch, or flushes it if it
+        reached the maximum size.
+        path: the path of the directory the file is located in
+        name: the name of the file
+        size: the size of the file in bytes
+        """
+        queue = self._queues.get(path)
+        if queue == None:
+            queue = self._queues.setdefault(path, DirectoryQueue(path))
+        queue.last = time.time()
+        queue.put(name, size)
+
+        # the scheduler clears the flag before it takes the files, so a file
+        # added in between is either taken or triggers a new deadline. If two
+        # threads schedule the batch at once, the later deadline is skipped.
+        if not queue.scheduled:
+            self._schedule(queue)
+        elif (not queue.flushing) and self._is_full(queue):
+            queue.flushing = True
+            self._push(0, queue)
+
+    def discard(self, path):
+        """
+        Drops the pending batch of a directory, e.g. if it was deleted.
+        path: the path of the directory
+        """
+        self._queues.pop(path, None)
 
     def run(self):
         """
-        The main run method of the thread. Waits for the delay time and, if not
-        stopped, calls the file handler method.
+        The main run method of the thread. Waits for the next deadline and
+        hands the batches that are due to the worker pool.
         """
-        self._stop.wait(self._delay)
-        if not self.stopped():
-            # copy file list and clear referenced file list
-            local_file_list = []
-            fh_lock.acquire()
+        self._pool.start()
+        while not self.stopped():
+            self._condition.acquire()
             try:
-                local_file_list = self._file_list[:]
-                del self._file_list[:]
+                while not self._deadlines and not self.stopped():
+                    self._condition.wait()
+                if self.stopped():
+                    break
+                deadline, _, generation, queue = self._deadlines[0]
+                wait_time = deadline - time.time()
+                if wait_time > 0:
+                    self._condition.wait(wait_time)
+                    continue
+                heapq.heappop(self._deadlines)
             finally:
-                fh_lock.release()
+                self._condition.release()
+
+            # skip queues of directories that have been removed in the
+            # meantime and deadlines of batches that were already handed out
+            if (self._queues.get(queue.path) is not queue) or \
+               (generation != queue.generation):
+                continue
+
+            # the deadline is moved if new files arrived during the delay
+            due = self._due(queue)
+            if due > time.time():
+                self._push(due, queue)
+                continue
+
+            queue.generation += 1
+            queue.scheduled = False
+            queue.flushing = False
+            file_list = queue.take(queue.max_files, self._max_bytes)
+            if file_list:
+                self._pool.submit(queue.path, file_list)
+
+            # files left over by a size limited batch start a new batch
+            if len(queue) and not queue.scheduled:
+                self._schedule(queue)
+        self._pool.stop()
+        logger.info("Batch scheduler was stopped")
 
-            # process file handler
-            self._file_handler.process(self._path, local_file_list)
+    def _schedule(self, queue):
+        """
+        Starts a new batch for the queue and pushes its deadline.
+        queue: the directory queue
+        """
+        queue.delay, queue.max_files = self._delay, self._max_files
+        window = self._file_handler.batch_window(queue.path)
+        if window != None:
+            queue.delay, queue.max_files = window
+        queue.scheduled = True
+        queue.first = time.time()
+        if self._is_full(queue):
+            queue.flushing = True
+            self._push(0, queue)
         else:
-            logger.info("File handler thread was stopped")
+            self._push(queue.first+queue.delay, queue)
+
+    def _push(self, deadline, queue):
+        """
+        Pushes a deadline for the current batch of the queue onto the heap.
+        deadline: the time at which the batch is due
+        queue: the directory queue
+        """
+        self._condition.acquire()
+        try:
+            heapq.heappush(self._deadlines, (deadline, next(self._counter),
+                                             queue.generation, queue))
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def _is_full(self, queue):
+        """
+        Returns True if the queue reached the maximum number of files or
+        bytes. Files that were added several times are counted each time,
+        so a directory can't grow without bounds by rewriting files.
+        queue: the directory queue
+        """
+        return (queue.max_files and len(queue) >= queue.max_files) or \
+               (self._max_bytes and queue.pending_bytes() >= self._max_bytes)
+
+    def _due(self, queue):
+        """
+        Returns the time at which the current batch of the queue is due.
+        queue: the directory queue
+        """
+        if queue.flushing:
+            return 0
+        if self._max_latency > 0:
+            return min(queue.last+queue.delay, queue.first+self._max_latency)
+        return queue.first+queue.delay
 
     def stop(self):
         """
         Stops the thread.
         """
         self._stop.set()
+        self._condition.acquire()
+        try:
+            self._condition.notify()
+        finally:
+            self._condition.release()
 
     def stopped(self):
         """
@@ -61,161 +406,398 @@ class FileHandlerThread(threading.Thread):
         return self._stop.is_set()
 
 
-class Node(object):
+class WatchIndex(object):
+    """
+    Flat index of the watched directories. Maps the watch descriptors to the
+    directory paths and back, and keeps the names of the sub-directories of
+    each directory so a sub-tree can be found without walking the filesystem.
+    """
+    def __init__(self):
+        """
+        Constructor of the watch index class
+        """
+        self._paths = {}
+        self._wds = {}
+        self._children = {}
+
+    def __len__(self):
+        return len(self._wds)
+
+    def __contains__(self, path):
+        return path in self._wds
+
+    def add(self, path, wd):
+        """
+        Adds a watched directory to the index
+        path: the path of the watched directory
+        wd: the watch descriptor of the directory
+        """
+        self._paths[wd] = path
+        self._wds[path] = wd
+        parent, name = os.path.split(path)
+        if parent in self._wds:
+            self._children.setdefault(parent, set()).add(name)
+
+    def remove(self, path):
+        """
+        Removes a directory from the index and returns its watch descriptor.
+        Returns None if the directory was not indexed.
+        path: the path of the watched directory
+        """
+        wd = self._wds.pop(path, None)
+        if wd != None and self._paths.get(wd) == path:
+            del self._paths[wd]
+        self._children.pop(path, None)
+        parent, name = os.path.split(path)
+        siblings = self._children.get(parent)
+        if siblings != None:
+            siblings.discard(name)
+            if not siblings:
+                del self._children[parent]
+        return wd
+
+    def path(self, wd):
+        """
+        Returns the path for the watch descriptor or None if it is unknown
+        """
+        return self._paths.get(wd)
+
+    def wd(self, path):
+        """
+        Returns the watch descriptor for the path or None if it is unknown
+        """
+        return self._wds.get(path)
+
+    def paths(self):
+        """
+        Returns the list of all indexed directories
+        """
+        return self._wds.keys()
+
+    def subtree(self, path):
+        """
+        Returns the list of indexed directories below and including the
+        specified path.
+        path: the root of the sub-tree
+        """
+        if path not in self._wds:
+            return []
+        result = []
+        stack = [path]
+        while stack:
+            curr_path = stack.pop()
+            result.append(curr_path)
+            for name in self._children.get(curr_path, ()):
+                stack.append(os.path.join(curr_path, name))
+        return result
+
+
+class TimedNotifier(pyinotify.Notifier):
     """
-    A single node in the directory tree.
+    Notifier that records the time of the reads of the event queue. Events
+    that are dropped by an overflow of the kernel queue were generated after
+    the previous read, which can be long before the overflow is processed.
     """
+    def __init__(self, *args, **kwargs):
+        """
+        Constructor of the timed notifier class. Takes the arguments of the
+        pyinotify notifier.
+        """
+        pyinotify.Notifier.__init__(self, *args, **kwargs)
+        self.last_read = time.time()
+        self.previous_read = self.last_read
 
-    def __init__(self, watch_manager, file_handler, regex=None, delay=0):
+    def read_events(self):
         """
-        Constructor of the tree node.
-        watch_manager: reference to the watch manager that maintains the watches.
+        Reads the events from the queue and records the time of the read.
+        """
+        self.previous_read = self.last_read
+        self.last_read = time.time()
+        pyinotify.Notifier.read_events(self)
+
+
+class WatchTree(object):
+    """
+    The tree of folders that are being watched for changes. Implements the full
+    hierarchical structure of the target directories. If a folder is created,
+    renamed or deleted, the part of the tree that is affected by this change
+    is automatically rebuild. The associated pyinotify watches are also updated.
+    The tree is stored as a flat index of watch descriptors and paths, and all
+    notification events are handled by the tree itself.
+    """
+    def __init__(self, file_handler, exclude="", delay=0, workers=4,
+                 max_files=0, max_bytes=0, max_latency=0, read_freq=0,
+                 max_queued_events=0, rescan_margin=10, watch_batch=1000,
+                 mask=WATCH_MASK):
+        """
+        Constructor of the watch tree class
         file_handler: reference to a file handler object
-        regex: a regex for excluding files from the watch
+        exclude: an ExcludeFilter or a regex for excluding files from the watch
         delay: time in seconds to aggregate together several events
+        workers: the maximum number of batches that are processed concurrently
+        max_files: maximum number of files in a batch (0: no limit)
+        max_bytes: maximum number of bytes in a batch (0: no limit)
+        max_latency: maximum time in seconds the first file of a batch waits
+                     (0: the batch is handed out after the delay time)
+        read_freq: time in seconds between reads of the event queue. Events
+                   are read in bigger chunks, at the cost of latency.
+        max_queued_events: size of the kernel event queue (0: system default)
+        rescan_margin: time in seconds the rescan after a queue overflow
+                       reaches back before the previous read of the queue
+        watch_batch: number of directories registered per add_watch call
+        mask: the inotify events that are watched. Without IN_CLOSE_WRITE
+              only the directories are watched and no file is processed.
         """
-        self._wd = -1
-        self._nodes = {}
-        self._watch_manager = watch_manager
+        if max_queued_events > 0:
+            try:
+                pyinotify.max_queued_events.value = max_queued_events
+            except (IOError, OSError), e:
+                logger.error("Couldn't set the size of the event queue: %s"%e)
+        self._watch_manager = pyinotify.WatchManager()
+        self._notifier = TimedNotifier(self._watch_manager,
+                                       default_proc_fun=self.handle_event,
+                                       read_freq=read_freq)
+        self._index = WatchIndex()
         self._file_handler = file_handler
-        self._regex = regex
-        self._delay = delay
-        self._fh_thread = FileHandlerThread(delay, [], file_handler, "")
-        self._files = []
+        self._mask = mask
+        # a tree of directories only needs no batches and no workers
+        if mask & pyinotify.IN_CLOSE_WRITE:
+            self._scheduler = BatchScheduler(file_handler, delay, workers,
+                                             max_files, max_bytes, max_latency)
+        else:
+            self._scheduler = None
+        self._track_size = max_bytes > 0
+        if isinstance(exclude, basestring):
+            exclude = filters.ExcludeFilter(exclude)
+        self._exclude = exclude
+        self._watch_batch = watch_batch
+        self._rescan_margin = rescan_margin
+        self._counters = {'overflows': 0,
+                          'rescanned_dirs': 0,
+                          'rescanned_files': 0}
+
+    def create(self, root):
+        """
+        Create the initial tree. Starts with the root directory and adds the
+        watches for all its sub-directories.
+        root: the root directory from which the tree creation is started with.
+        """
+        self._add_subtree(root)
+        logger.info("Watching %i directories below '%s'"%(len(self._index), root))
 
-    def create(self, path):
+    def watch(self):
         """
-        Create a watch for this node and the child nodes for the sub-directories
-        of the specified path
-        path: the path of this node and the parent path for this nodes children
+        Start watching.
         """
-        # add a watch on this node
-        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | \
-               pyinotify.IN_DELETE | pyinotify.IN_MOVED_TO | \
-               pyinotify.IN_MOVED_FROM
+        if self._scheduler == None:
+            self._notifier.loop()
+            return
+        self._scheduler.start()
         try:
-            wd = self._watch_manager.add_watch(path, mask,
-                                               proc_fun=self.handle_event,
-                                               quiet=False).items()[0]
-            self._wd = wd[1]
-            logger.info("Added watch '%i' for '%s'"%(self._wd,path))
-        except pyinotify.WatchManagerError, e:
-            logger.error("Couldn't add watch: %s, %s"%(e, e.wmd))
-
-        # add the nodes for the sub-directories recursively
-        for curr_dir in os.listdir(path):
-            abs_dir = os.path.join(path, curr_dir)
-            if os.path.isdir(abs_dir):
-                new_node = Node(self._watch_manager,
-                                self._file_handler,
-                                self._regex,
-                                self._delay)
-                self._nodes[curr_dir] = new_node
-                new_node.create(abs_dir)
-
-    def delete(self):
-        """
-        Deletes the watch of this node and all children nodes
-        """
-        if self._wd > -1:
-            try:
-                # stop a running aggregation thread
-                if self._fh_thread.is_alive():
-                    self._fh_thread.stop()
-
-                # remove watch
-                self._watch_manager.rm_watch(self._wd, quiet=False)
-                logger.info("Removed watch '%i' successfully"%self._wd)
-                self._wd = -1
-            except pyinotify.WatchManagerError, e:
-                logger.error("Couldn't remove watch: %s, %s"%(e, e.wmd))
-        for key, node in self._nodes.iteritems():
-            node.delete()
-        self._nodes.clear()
+            self._notifier.loop()
+        finally:
+            self._scheduler.stop()
+
+    def add_file(self, path, name, size=0):
+        """
+        Adds a file to the pending batch of its directory as if it had been
+        notified, e.g. for files that were missed while not watching.
+        path: the path of the directory the file is located in
+        name: the name of the file
+        size: the size of the file in bytes
+        """
+        if self._scheduler != None:
+            self._scheduler.add(path, name, size)
+
+    def counters(self):
+        """
+        Returns a dictionary with the number of event queue overflows and
+        the number of directories and files found by the following rescans.
+        """
+        return dict(self._counters)
 
     def handle_event(self, event):
         """
         The callback method for notification events
-        A thread is started in order to wait for the delay time. Afterwards
-        it calls the rsync process. In the meantime calls to this method are
-        simply not handled.
+        The notified files are added to the pending batch of their directory,
+        which is handed to the file handler by the batch scheduler once the
+        delay time has passed.
         event: the pyinotify event object
         """
-        # if it is a directory remove it and its sub-nodes then rebuild the sub-tree.
+        # the kernel dropped events, rescan the directories modified since
+        # the read before the one that reported the overflow
+        if event.mask & pyinotify.IN_Q_OVERFLOW:
+            self._rescan(self._notifier.previous_read-self._rescan_margin)
+            return
+
+        # the kernel removed the watch (e.g. the directory was deleted)
+        if event.mask & pyinotify.IN_IGNORED:
+            path = self._index.path(event.wd)
+            if path != None:
+                self._remove_subtree(path)
+            return
+
+        # if it is a directory remove it and its sub-directories then
+        # rebuild the sub-tree.
         if event.dir:
-            if (event.name != None) and (event.name in self._nodes):
-                self._nodes[event.name].delete()
-                del self._nodes[event.name]
+            if (event.name != None) and (event.pathname in self._index):
+                self._remove_subtree(event.pathname)
                 logger.info("Deleted node '%s' and its sub-tree '%s'"%\
                             (event.name, event.pathname))
             if os.path.exists(event.pathname):
-                new_node = Node(self._watch_manager,
-                                self._file_handler,
-                                self._regex,
-                                self._delay)
-                self._nodes[event.name] = new_node
                 logger.info("Adding node '%s' and its sub-tree '%s'"%\
                             (event.name, event.pathname))
-                new_node.create(event.pathname)
-        else:
+                self._add_subtree(event.pathname)
+        elif self._scheduler != None:
             # handle files that have been closed after writing or
             # files that have been moved to the watched folder.
             if event.mask == pyinotify.IN_CLOSE_WRITE or \
                event.mask == pyinotify.IN_MOVED_TO:
-                # Skip files that match the exclude regex
-                if self._regex != None and self._regex.search(event.name) != None:
+                # Skip files that match the exclude filter
+                if self._exclude.excluded(event.name):
                     return
 
-                # Add the file to the list of notified files
-                if os.path.exists(event.path):
-                    fh_lock.acquire()
+                # Add the file to the pending batch of its directory. The
+                # file size is only needed if the batches are size limited.
+                if self._track_size:
                     try:
-                        self._files.append(event.name)
-                    finally:
-                        fh_lock.release()
+                        size = os.path.getsize(event.pathname)
+                    except OSError:
+                        return
+                    self._scheduler.add(event.path, event.name, size)
+                elif os.path.exists(event.path):
+                    self._scheduler.add(event.path, event.name)
 
-                # If the thread is not running yet, start it
-                if not self._fh_thread.is_alive():
-                    self._fh_thread = FileHandlerThread(self._delay,
-                                                        self._files,
-                                                        self._file_handler,
-                                                        event.path)
-                    self._fh_thread.start()
+    def _rescan(self, since):
+        """
+        Recovers the events that were dropped by an overflow of the event
+        queue. Only the directories that were modified after the specified
+        time are listed. New sub-directories are added to the tree with all
+        their files, and the files that were modified after the specified
+        time are added to the pending batches.
+        since: the time from which on events might have been dropped
+        """
+        start_time = time.time()
+        self._counters['overflows'] += 1
+        n_dirs = 0
+        n_files = 0
+        for path in self._index.paths():
+            try:
+                if os.stat(path).st_mtime < since:
+                    continue
+                names = os.listdir(path)
+            except OSError:
+                continue
+            n_dirs += 1
+            for name in names:
+                abs_path = os.path.join(path, name)
+                try:
+                    st = os.stat(abs_path)
+                except OSError:
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    if abs_path not in self._index:
+                        added = self._add_subtree(abs_path)
+                        n_dirs += len(added)
+                        if self._scheduler != None:
+                            n_files += self._add_new_files(added)
+                elif stat.S_ISREG(st.st_mode) and (st.st_mtime >= since) and \
+                     (self._scheduler != None):
+                    if not self._exclude.excluded(name):
+                        self._scheduler.add(path, name, st.st_size)
+                        n_files += 1
 
+        self._counters['rescanned_dirs'] += n_dirs
+        self._counters['rescanned_files'] += n_files
+        logger.error(("Event queue overflow (%i so far): rescanned %i "%\
+                      (self._counters['overflows'], n_dirs))+
+                     ("directories and found %i files in %.1f s"%\
+                      (n_files, time.time()-start_time)))
 
-class WatchTree(object):
-    """
-    The tree of folders that are being watched for changes. Implements the full
-    hierarchical structure of the target directories. If a folder is created,
-    renamed or deleted, the part of the tree that is affected by this change
-    is automatically rebuild. The associated pyinotify watches are also updated.
-    """
-    def __init__(self, file_handler, exclude="", delay=0):
+    def _add_new_files(self, paths):
         """
-        Constructor of the watch tree class
-        file_handler: reference to a file handler object
-        exclude: a regex for excluding files from the watch
-        delay: time in seconds to aggregate together several events
+        Adds the regular files of new directories to the pending batches.
+        The watches of the directories have to be in place, so files created
+        later on are notified. Returns the number of added files.
+        paths: the paths of the new directories
         """
-        self._watch_manager = pyinotify.WatchManager()
-        self._notifier = pyinotify.Notifier(self._watch_manager)
-        self._root = Node(self._watch_manager, file_handler,
-                          re.compile(exclude) if exclude else None,
-                          delay)
+        n_files = 0
+        for path in paths:
+            try:
+                names = os.listdir(path)
+            except OSError:
+                continue
+            for name in self._exclude.filter(names):
+                try:
+                    st = os.stat(os.path.join(path, name))
+                except OSError:
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    self._scheduler.add(path, name, st.st_size)
+                    n_files += 1
+        return n_files
 
-    def create(self, root):
+    def _scan(self, root):
         """
-        Create the initial tree. Starts with the root directory and builds the
-        tree structure recursively.
-        root: the root directory from which the tree creation is started with.
+        Returns the list of directories below and including the root
+        directory. The directories are listed iteratively, so deep trees
+        don't hit the recursion limit.
+        root: the root directory of the scan
         """
-        self._root.create(root)
+        result = [root]
+        stack = [root]
+        while stack:
+            path = stack.pop()
+            try:
+                for name in list_subdirs(path):
+                    abs_dir = os.path.join(path, name)
+                    result.append(abs_dir)
+                    stack.append(abs_dir)
+            except OSError, e:
+                logger.error("Couldn't list directory '%s': %s"%(path, e))
+        return result
 
-    def watch(self):
+    def _add_subtree(self, root):
         """
-        Start watching.
+        Scans the root directory and adds a watch for it and each of its
+        sub-directories. The watches are registered in batches. Returns the
+        paths of the directories that are watched.
+        root: the root directory of the sub-tree
+        """
+        paths = self._scan(root)
+        watched = []
+        for i in range(0, len(paths), self._watch_batch):
+            batch = paths[i:i+self._watch_batch]
+            wds = self._watch_manager.add_watch(batch, self._mask, quiet=True)
+            for path in batch:
+                wd = wds.get(path, -1)
+                if wd < 0:
+                    logger.error("Couldn't add watch for '%s'"%path)
+                else:
+                    self._index.add(path, wd)
+                    watched.append(path)
+                    logger.debug("Added watch '%i' for '%s'"%(wd, path))
+        self._file_handler.tree_changed(paths, [])
+        return watched
+
+    def _remove_subtree(self, root):
+        """
+        Removes the watches of the root directory and all its sub-directories
+        and drops their pending batches.
+        root: the root directory of the sub-tree
         """
-        self._notifier.loop()
+        paths = self._index.subtree(root)
+        wds = []
+        for path in reversed(paths):
+            wd = self._index.remove(path)
+            if self._scheduler != None:
+                self._scheduler.discard(path)
+            if (wd != None) and (self._watch_manager.get_path(wd) != None):
+                wds.append(wd)
+        if wds:
+            self._watch_manager.rm_watch(wds, quiet=True)
+            logger.info("Removed %i watches below '%s'"%(len(wds), root))
+        self._file_handler.tree_changed([], paths)
 
 
 class WatchTreeFileHandler(object):
@@ -223,9 +805,37 @@ class WatchTreeFileHandler(object):
     Abstract base class for handling file change notifications.
     Inherit this class to create your own handler.
     """
-    def process(self, path):
+    def target(self, path):
+        """
+        Returns the target of the files in a directory. Batches with the
+        same target are never processed concurrently.
+        path: the path of the directory
+        """
+        return path
+
+    def batch_window(self, path):
+        """
+        Returns the delay in seconds and the maximum number of files (0: no
+        limit) for a new batch of a directory, or None to use the settings
+        of the watch tree.
+        path: the path of the directory
+        """
+        return None
+
+    def tree_changed(self, added, removed):
+        """
+        This method is called every time directories have been added to or
+        removed from the watch tree, including the initial tree.
+        added: the paths of the added directories
+        removed: the paths of the removed directories
+        """
+        pass
+
+    def process(self, path, file_list):
         """
-        This method is called every time a file was finished writing.
-        path: the path to the file.
+        This method is called for every batch of files that were finished
+        writing to a directory.
+        path: the path of the directory the files are located in
+        file_list: the names of the files
         """
         pass
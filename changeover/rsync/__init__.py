@@ -1,7 +1,10 @@
+import sys
+import json
+import signal
 import logging
 import argparse
-from changeover.common import settings, watchtree
-from changeover.rsync import eventhandler
+from changeover.common import settings, filters, sshmaster, watchtree
+from changeover.rsync import adaptive, compression, eventhandler, journal, ledger, reconcile
 from common import saxslog
 
 # parse the command line arguments
@@ -22,9 +25,70 @@ if raven_client != None:
     saxslog.setup_logging(saxslog.SentryHandler(raven_client))
     logger.info("Raven is available. Logging will be sent to Sentry")
 
+# exit cleanly if the daemon is stopped (e.g. by supervisor), so the exit
+# handlers run and the ssh master connection is stopped
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+# start the ssh master connection that is shared by all rsync calls
+conf = settings.Settings()
+if conf['rsync']['multiplex'] == True:
+    sshmaster.start()
+
+# open the ledger of the synced files
+sync_ledger = None
+if conf['reconcile']['ledger']:
+    sync_ledger = ledger.Ledger(conf['reconcile']['ledger'])
+
+# open the journal of the failed batches
+retry_journal = None
+if conf['retry']['journal']:
+    retry_journal = journal.Journal(conf['retry']['journal'],
+                                    float(conf['retry']['min_backoff']),
+                                    float(conf['retry']['max_backoff']))
+
+# tune the batch window of each target from the observed rsync throughput
+batching = None
+if conf['adaptive']['enabled'] == True:
+    batching = adaptive.AdaptiveBatching(float(conf['adaptive']['latency']),
+                                         float(conf['adaptive']['min_delay']),
+                                         float(conf['adaptive']['max_delay']),
+                                         int(conf['adaptive']['max_files']))
+
+# decide per file whether compression pays off for the link
+policy = None
+if conf['compression']['policy'] == True:
+    incompressible = conf['compression']['incompressible']
+    policy = compression.CompressionPolicy(float(conf['compression']['link_speed'])*1e6,
+                                           json.loads(incompressible) if incompressible else [],
+                                           int(conf['compression']['sample_size']))
+
 # create the watch tree
-wt = watchtree.WatchTree(eventhandler.EventHandler(),
-                         settings.Settings()['source']['exclude'],
-                         int(settings.Settings()['rsync']['delay']))
-wt.create(settings.Settings()['source']['watch'])
+wt = watchtree.WatchTree(eventhandler.EventHandler(sync_ledger, batching,
+                                                   retry_journal, policy),
+                         filters.exclude_filter(),
+                         int(conf['rsync']['delay']),
+                         int(conf['rsync']['workers']),
+                         int(conf['rsync']['max_files']),
+                         int(conf['rsync']['max_bytes']),
+                         float(conf['rsync']['max_latency']),
+                         float(conf['source']['read_freq']),
+                         int(conf['source']['max_queued_events']),
+                         float(conf['source']['rescan_margin']))
+wt.create(conf['source']['watch'])
 logger.info("Created the watch tree notification system")
+
+# catch up with the files that were written while the daemon was down
+if sync_ledger != None:
+    reconcile.Reconciler(wt, sync_ledger,
+                         filters.exclude_filter(),
+                         int(conf['reconcile']['workers']),
+                         float(conf['reconcile']['rate']),
+                         float(conf['reconcile']['margin'])).start()
+    logger.info("Started the reconciliation of the source folders")
+
+# retry the failed batches, including those of a previous run
+if retry_journal != None:
+    journal.Replayer(wt, retry_journal,
+                     float(conf['retry']['interval']),
+                     int(conf['retry']['chunk'])).start()
+    logger.info("Started the replay of the failed batches")
@@ -0,0 +1,144 @@
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class TargetModel(object):
+    """
+    Observed transfer behaviour of a single target folder. The duration of a
+    batch is modelled as a fixed cost per batch plus a cost per file,
+    estimated by an exponentially weighted least squares fit over the
+    previous batches. The arrival rate of files is estimated the same way.
+    """
+    __slots__ = ('delay', 'max_files', 'n', 't', 'nn', 'nt', 'rate',
+                 'bytes_per_s', 'last_update')
+
+    def __init__(self, delay, max_files):
+        self.delay = delay
+        self.max_files = max_files
+        self.n = None
+        self.t = 0
+        self.nn = 0
+        self.nt = 0
+        self.rate = 0
+        self.bytes_per_s = 0
+        self.last_update = None
+
+    def costs(self):
+        """
+        Returns the estimated fixed cost per batch and cost per file in
+        seconds.
+        """
+        var = self.nn-self.n*self.n
+        if var > 1e-6:
+            per_file = max(0, (self.nt-self.n*self.t)/var)
+        else:
+            per_file = self.t/self.n if self.n > 0 else 0
+        return max(0, self.t-per_file*self.n), per_file
+
+
+class AdaptiveBatching(object):
+    """
+    Tunes the batch window of each target folder from the observed rsync
+    throughput. The delay is made as long as possible, so batches get big
+    and the fixed cost per batch is shared by many files, while the time
+    from the first file of a batch to the end of its transfer stays below
+    the latency target. The maximum number of files is set so a batch can
+    still be transferred within the latency target. If the target can't be
+    met, e.g. for a slow archive, the window is opened to its upper bounds.
+    """
+    def __init__(self, latency, min_delay=0, max_delay=30, max_files=10000,
+                 weight=0.3):
+        """
+        Constructor of the adaptive batching class
+        latency: the target latency in seconds
+        min_delay: the lower bound of the delay in seconds
+        max_delay: the upper bound of the delay in seconds
+        max_files: the upper bound of the number of files per batch
+        weight: weight of the latest batch in the estimates (0..1)
+        """
+        self._latency = latency
+        self._min_delay = min_delay
+        self._max_delay = max_delay
+        self._max_files = max_files
+        self._weight = weight
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def window(self, target):
+        """
+        Returns the delay in seconds and the maximum number of files for the
+        next batch of a target folder.
+        target: the target folder
+        """
+        model = self._models.get(target)
+        if model == None:
+            return self._min_delay, self._max_files
+        return model.delay, model.max_files
+
+    def update(self, target, n_files, n_bytes, elapsed):
+        """
+        Updates the estimates of a target folder with a finished batch and
+        tunes its batch window.
+        target: the target folder
+        n_files: the number of files in the batch
+        n_bytes: the number of transferred bytes
+        elapsed: the duration of the transfer in seconds
+        """
+        if n_files <= 0:
+            return
+        now = time.time()
+        w = self._weight
+        self._lock.acquire()
+        try:
+            model = self._models.get(target)
+            if model == None:
+                model = TargetModel(self._min_delay, self._max_files)
+                self._models[target] = model
+
+            # update the weighted moments of the batch size and duration
+            if model.n == None:
+                model.n, model.t = float(n_files), elapsed
+                model.nn, model.nt = float(n_files*n_files), n_files*elapsed
+            else:
+                model.n = (1-w)*model.n + w*n_files
+                model.t = (1-w)*model.t + w*elapsed
+                model.nn = (1-w)*model.nn + w*n_files*n_files
+                model.nt = (1-w)*model.nt + w*n_files*elapsed
+            if elapsed > 0:
+                model.bytes_per_s = (1-w)*model.bytes_per_s + w*n_bytes/elapsed
+
+            # estimate the arrival rate from the time between batches
+            if model.last_update != None and now > model.last_update:
+                rate = n_files/(now-model.last_update)
+                model.rate = (1-w)*model.rate + w*rate if model.rate else rate
+            model.last_update = now
+
+            # the first file of a batch waits for the delay, then the batch
+            # of rate*delay files is transferred:
+            #   delay + per_batch + per_file*rate*delay <= latency
+            per_batch, per_file = model.costs()
+            budget = self._latency-per_batch
+            if budget-self._min_delay <= per_file:
+                # the latency target can't be met even for a single file,
+                # so the batches are made as big as possible for throughput
+                model.delay = self._max_delay
+                model.max_files = self._max_files
+            else:
+                delay = budget/(1+per_file*model.rate)
+                model.delay = min(self._max_delay, max(self._min_delay, delay))
+
+                # limit the batch size so its transfer fits into the latency
+                if per_file > 0:
+                    max_files = int((budget-model.delay)/per_file)
+                    model.max_files = min(self._max_files, max(1, max_files))
+                else:
+                    model.max_files = self._max_files
+        finally:
+            self._lock.release()
+
+        logger.debug("Batch window for '%s': %.2f s, %i files (%.1f MB/s)"%\
+                     (target, model.delay, model.max_files,
+                      model.bytes_per_s/1e6))
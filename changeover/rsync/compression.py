@@ -0,0 +1,198 @@
+import os
+import time
+import zlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# zlib level rsync uses for -z
+ZLIB_LEVEL = 6
+
+
+class ExtensionModel(object):
+    """
+    Observed compressibility of the files with a certain extension: the
+    ratio of the compressed to the original size and the compression speed
+    in bytes per second, estimated from samples of the files.
+    """
+    __slots__ = ('ratio', 'speed', 'samples')
+
+    def __init__(self, ratio=1.0, speed=0.0):
+        self.ratio = ratio
+        self.speed = speed
+        self.samples = 0
+
+
+class CompressionPolicy(object):
+    """
+    Decides per file whether rsync should compress it. Compression pays off
+    if the time to compress a file is shorter than the time saved on the
+    link. The compressibility of each file extension is sampled from the
+    first files with that extension, and the link speed is measured from the
+    uncompressed transfers. Files with an extension listed as incompressible
+    are never compressed.
+    """
+    def __init__(self, link_speed, incompressible=[], sample_size=65536,
+                 samples=3, weight=0.3):
+        """
+        Constructor of the compression policy class
+        link_speed: the initial estimate of the link speed in bytes per second
+        incompressible: list of extensions of already compressed files
+        sample_size: the number of bytes read from a file to sample it
+        samples: the number of files sampled per extension
+        weight: weight of the latest measurement in the estimates (0..1)
+        """
+        self._link_speed = float(link_speed)
+        self._incompressible = set(e.lower() for e in incompressible)
+        self._sample_size = sample_size
+        self._samples = samples
+        self._weight = weight
+        self._models = {}
+        self._lock = threading.Lock()
+        self.bytes_saved = 0
+        self.seconds_saved = 0.0
+
+    def split(self, source, file_list):
+        """
+        Splits a batch into the files that should be compressed and those
+        that should not. Returns a list of (compress, file list) tuples
+        without empty lists.
+        source: the source path
+        file_list: the list of files of the batch
+        """
+        compressed = []
+        plain = []
+        for f in file_list:
+            if self.compress(os.path.join(source, f)):
+                compressed.append(f)
+            else:
+                plain.append(f)
+        return [(c, l) for c, l in [(True, compressed), (False, plain)] if l]
+
+    def compress(self, path):
+        """
+        Returns True if a file should be compressed.
+        path: the path of the file
+        """
+        ext = os.path.splitext(path)[1].lower()
+        if ext in self._incompressible:
+            return False
+        model = self._models.get(ext)
+        if (model == None) or (model.samples < self._samples):
+            model = self._sample(ext, path)
+        return self._worth(model.ratio, model.speed)
+
+    def update(self, statistics, compressed):
+        """
+        Updates the link speed from the stats of an uncompressed transfer
+        and adds the bytes and seconds saved by the decision to the stats
+        and to the totals.
+        statistics: the dictionary as it is returned by syncutils.run_rsync()
+        compressed: True if the batch was compressed
+        """
+        size = statistics['literal_data'] or statistics['size_transferred']
+        sent = statistics.get('bytes_sent', size)
+        elapsed = statistics['elapsed']
+        bytes_saved = 0
+        seconds_saved = 0.0
+        self._lock.acquire()
+        try:
+            # small transfers are dominated by the latency of the link
+            if (not compressed) and (sent > 1048576) and (elapsed > 0):
+                w = self._weight
+                self._link_speed = (1-w)*self._link_speed + w*sent/elapsed
+
+            if size > 0:
+                speed = self._speed([item[0] for item in statistics['items']])
+                if compressed:
+                    ratio = min(1.0, float(sent)/size)
+                    bytes_saved = max(0, size-sent)
+                else:
+                    ratio = self._ratio([item[0] for item in statistics['items']])
+                plain_time = size/self._link_speed
+                zlib_time = max(size/speed if speed > 0 else 0,
+                                ratio*size/self._link_speed)
+                if compressed:
+                    seconds_saved = plain_time-zlib_time
+                else:
+                    seconds_saved = zlib_time-plain_time
+            self.bytes_saved += bytes_saved
+            self.seconds_saved += seconds_saved
+        finally:
+            self._lock.release()
+        statistics['compressed'] = compressed
+        statistics['bytes_saved'] = bytes_saved
+        statistics['seconds_saved'] = seconds_saved
+
+    def _worth(self, ratio, speed):
+        """
+        Returns True if compressing data with a compression ratio and speed
+        is faster than sending it uncompressed. rsync compresses and sends
+        at the same time, so the slower of the two decides.
+        ratio: the ratio of the compressed to the original size
+        speed: the compression speed in bytes per second
+        """
+        if (speed <= 0) or (ratio >= 1.0):
+            return False
+        return max(1.0/speed, ratio/self._link_speed) < 0.9/self._link_speed
+
+    def _sample(self, ext, path):
+        """
+        Compresses the beginning of a file and updates the model of its
+        extension. Returns the model.
+        ext: the extension of the file
+        path: the path of the file
+        """
+        try:
+            f = open(path, 'rb')
+            try:
+                data = f.read(self._sample_size)
+            finally:
+                f.close()
+        except IOError:
+            data = ""
+
+        self._lock.acquire()
+        try:
+            model = self._models.get(ext)
+            if model == None:
+                model = ExtensionModel()
+                self._models[ext] = model
+            if len(data) > 0:
+                start_time = time.time()
+                ratio = len(zlib.compress(data, ZLIB_LEVEL))/float(len(data))
+                speed = len(data)/max(time.time()-start_time, 1e-6)
+                n = model.samples
+                model.ratio = (model.ratio*n+ratio)/(n+1)
+                model.speed = (model.speed*n+speed)/(n+1)
+            model.samples += 1
+            if model.samples == self._samples:
+                logger.info("Compression of '%s' files: ratio %.2f, %.0f MB/s, %s"%\
+                            (ext, model.ratio, model.speed/1e6,
+                             "on" if self._worth(model.ratio, model.speed) else "off"))
+        finally:
+            self._lock.release()
+        return model
+
+    def _ratio(self, names):
+        """
+        Returns the average estimated compression ratio of files. Has to be
+        called with the lock held.
+        names: the file names
+        """
+        ratios = [self._models[ext].ratio for ext in
+                  (os.path.splitext(n)[1].lower() for n in names)
+                  if ext in self._models]
+        return sum(ratios)/len(ratios) if ratios else 1.0
+
+    def _speed(self, names):
+        """
+        Returns the average estimated compression speed of files. Has to be
+        called with the lock held.
+        names: the file names
+        """
+        speeds = [self._models[ext].speed for ext in
+                  (os.path.splitext(n)[1].lower() for n in names)
+                  if ext in self._models]
+        return sum(speeds)/len(speeds) if speeds else 0.0
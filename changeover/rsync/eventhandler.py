@@ -1,11 +1,11 @@
 import os
-import json
 import socket
 import time
 import paramiko
+import threading
 from datetime import datetime, date
 from string import Template
-from changeover.common import syncutils, watchtree
+from changeover.common import filters, sshmaster, sshpool, syncutils, watchtree
 from changeover.common.settings import Settings
 from common import saxslog
 
@@ -13,17 +13,31 @@ class EventHandler(watchtree.WatchTreeFileHandler):
     """
     The handler class for processing the file notification events.
     """
-    def __init__(self):
+    def __init__(self, ledger=None, adaptive=None, journal=None,
+                 compression=None):
         """
         The constructor of the event handler.
+        ledger: reference to the ledger the synced files are recorded in
+        adaptive: reference to the adaptive batching that tunes the batch
+                  window of each target from the observed rsync throughput
+        journal: reference to the journal the files of failed batches are
+                 recorded in for a retry
+        compression: reference to the compression policy that decides per
+                     file whether it is compressed. Without a policy the
+                     compress setting applies to all files.
         """
         conf = Settings()
         self._logger, self._raven_client = saxslog.setup(__name__,
                                                          conf['logging']['debug'],
                                                          conf['logging']['sentry'])
         self._stats_file = None
+        self._stats_lock = threading.Lock()
         self._stats_file_datetime = datetime.now()
         self._flush_counter = 0
+        self._ledger = ledger
+        self._adaptive = adaptive
+        self._journal = journal
+        self._compression = compression
 
 
     def __del__(self):
@@ -34,6 +48,39 @@ class EventHandler(watchtree.WatchTreeFileHandler):
             self._stats_file.close()
 
 
+    def target(self, path):
+        """
+        Returns the rsync target path of a source directory. Batches with the
+        same target are synced one after the other.
+        path: the source directory
+        """
+        try:
+            return syncutils.build_sync_paths(path)[1]
+        except Exception:
+            return path
+
+
+    def batch_window(self, path):
+        """
+        Returns the delay and the maximum number of files of the next batch
+        of a source directory, or None to use the configured values.
+        path: the source directory
+        """
+        if self._adaptive == None:
+            return None
+        return self._adaptive.window(self.target(path))
+
+
+    def tree_changed(self, added, removed):
+        """
+        Keeps the list of source folders up to date with the watched
+        directories, so they don't have to be scanned.
+        added: the paths of the added directories
+        removed: the paths of the removed directories
+        """
+        syncutils.source_folders.update(added, removed)
+
+
     def process(self, path, file_list):
         """
         Run the rsync process after being notified of a change in the filesystem.
@@ -54,58 +101,85 @@ class EventHandler(watchtree.WatchTreeFileHandler):
                 self._logger.error(e)
             return
 
+        # the change times the ledger records are those rsync sees
+        ctimes = None
+        if self._ledger != None:
+            ctimes = self._ledger.ctimes(path, file_list)
+
         # Copy the files to the archive (mkdir + rsync)
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        pool = sshpool.pool()
+        client = None
+        broken = False
         try:
-            client.connect(conf['target']['host'],
-                           username=conf['target']['user'])
+            client = pool.acquire()
 
-            # if the remote directory doesn't exist, create it
+            # if the remote directory isn't known to exist, create it
             try:
-                dir_cmd = "[ -d \"%s\" ] && echo \"True\" || echo \"False\""%target
-                _, stdout, stderr = client.exec_command(dir_cmd)
-                client_error = stderr.read()
-                if client_error:
-                    logger.error("Couldn't check target folder: %s"%client_error.rstrip())
-                else:
-                    if stdout.read().rstrip() == "False":
-                        self._logger.info("Making remote directory: %s"%target)
-                        syncutils.mkdir_remote(target, client)
+                if target not in syncutils.remote_dirs:
+                    self._logger.info("Making remote directory: %s"%target)
+                    syncutils.mkdir_remote(target, client)
+                    syncutils.remote_dirs.add(target)
             except Exception, e:
+                self._retry(path, file_list, ctimes)
                 if self._raven_client != None:
                     self._raven_client.captureException()
                 else:
                     self._logger.error(e)
-                client.close()
                 return
 
-            # set the rsync options
-            options = "-a"
-            options += "z" if conf['rsync']['compress']==True else ""
-            options += "c" if conf['rsync']['checksum']==True else ""
-
             try:
-                # run the rsync process and get the stats dictionary
-                rsync_stats = syncutils.run_rsync(source, target, file_list,
-                                                  client, options,
-                                                  json.loads(conf['rsync']['exclude']))
-                self._write_stats_file(rsync_stats)
+                # copy the files with the method suited to the batch. Mixed
+                # batches are split into compressed and uncompressed parts.
+                method = self._transfer_method(source, file_list)
+                if (method != "sftp") and (self._compression != None):
+                    parts = self._compression.split(source, file_list)
+                else:
+                    parts = [(conf['rsync']['compress']==True, file_list)]
+
+                for compress, part_list in parts:
+                    rsync_stats = self._transfer(method, source, target,
+                                                 part_list, client, pool,
+                                                 compress)
+                    if (self._compression != None) and (method != "sftp"):
+                        self._compression.update(rsync_stats, compress)
+
+                    # the batch window is tuned from the rsync batches only
+                    if (self._adaptive != None) and (method == "rsync"):
+                        self._adaptive.update(target, len(part_list),
+                                              rsync_stats['size_transferred'],
+                                              rsync_stats['elapsed'])
+                    self._stats_lock.acquire()
+                    try:
+                        self._write_stats_file(rsync_stats)
+                    finally:
+                        self._stats_lock.release()
+
+                if self._ledger != None:
+                    self._ledger.update(path, ctimes)
+                if self._journal != None:
+                    self._journal.done(path, file_list)
 
             except Exception, e:
+                # the target directory might have been removed on the archive
+                syncutils.remote_dirs.discard(target)
+                self._retry(path, file_list, ctimes)
                 if self._raven_client != None:
                     self._raven_client.captureException()
                 else:
                     self._logger.error(e)
 
         except (paramiko.SSHException, socket.error), e:
+            broken = True
+            syncutils.remote_dirs.discard(target)
+            self._retry(path, file_list, ctimes)
             if self._raven_client != None:
                 self._raven_client.captureException()
             else:
                 self._logger.error("SSH connection threw an exception: %s"%e)
         finally:
-            # close ssh connection
-            client.close()
+            # return the ssh connection to the pool
+            if client != None:
+                pool.release(client, broken)
 
             # log time
             self._logger.info("Files synced: %i"%len(file_list))
@@ -113,6 +187,83 @@ class EventHandler(watchtree.WatchTreeFileHandler):
                               ((time.time()-start_time)/(1.0*len(file_list))))
             
 
+    def _transfer(self, method, source, target, file_list, client, pool,
+                  compress):
+        """
+        Copies the files with a transfer method and returns the stats
+        dictionary.
+        method: the transfer method ('rsync', 'sftp' or 'tar')
+        source: the source path
+        target: the target path
+        file_list: the list of files that should be copied
+        client: the ssh client
+        pool: the ssh pool the client was acquired from
+        compress: compress the data during the transfer
+        """
+        conf = Settings()
+        exclude_list = filters.exclude_filter().globs
+        if method == "sftp":
+            return syncutils.run_sftp(source, target, file_list, client,
+                                      pool.sftp(client), exclude_list)
+        if method == "tar":
+            return syncutils.run_tar(source, target, file_list, client,
+                                     compress, exclude_list)
+
+        # set the rsync options
+        options = "-a"
+        options += "z" if compress else ""
+        options += "c" if conf['rsync']['checksum']==True else ""
+        return syncutils.run_rsync(source, target, file_list, client, options,
+                                   exclude_list, sshmaster.rsh())
+
+
+    def _transfer_method(self, source, file_list):
+        """
+        Returns the transfer method of a batch. Batches of a few small files
+        are copied over sftp, batches of many tiny files as a tar stream and
+        all other batches with rsync. Batches with checksums are always
+        copied with rsync.
+        source: the source path
+        file_list: the list of files of the batch
+        """
+        conf = Settings()['rsync']
+        n_files = len(file_list)
+        if (conf['checksum'] == True) or (n_files == 0):
+            return "rsync"
+        sftp_files = int(conf['sftp_max_files'])
+        tar_files = int(conf['tar_min_files'])
+        if (n_files > sftp_files) and ((tar_files <= 0) or (n_files < tar_files)):
+            return "rsync"
+
+        size = 0
+        for f in file_list:
+            try:
+                size += os.stat(os.path.join(source, f)).st_size
+            except OSError:
+                pass
+        if n_files <= sftp_files:
+            if size <= int(conf['sftp_max_bytes']):
+                return "sftp"
+        elif size <= n_files*int(conf['tar_max_size']):
+            return "tar"
+        return "rsync"
+
+
+    def _retry(self, path, file_list, ctimes=None):
+        """
+        Records the files of a failed batch in the journal, from where they
+        are retried, and in the ledger. Without a journal the files are
+        synced again by the reconciliation after a restart.
+        path: the source directory
+        file_list: the names of the files of the failed batch
+        ctimes: dictionary of the files and their change times for the ledger
+        """
+        if (self._ledger != None) and (ctimes != None):
+            self._ledger.failed(path, ctimes)
+        if self._journal != None:
+            self._journal.failed(path, file_list)
+
+
     def _write_stats_file(self, statistics):
         """
         Write the rsync statistics to a file. The filename can contain a
@@ -138,12 +289,15 @@ class EventHandler(watchtree.WatchTreeFileHandler):
                self._open_stats_file()
 
         # write the statistics to the file
-        self._stats_file.write("%s %s %s %s %s %s => %s\n"%\
+        self._stats_file.write("%s %s %s %s %s %.3f %i %.3f %s => %s\n"%\
                                 (datetime.isoformat(datetime.now()),
                                 statistics['files_total'],
                                 statistics['files_transferred'],
                                 statistics['size_total'],
                                 statistics['size_transferred'],
+                                statistics['elapsed'],
+                                statistics.get('bytes_saved', 0),
+                                statistics.get('seconds_saved', 0),
                                 statistics['source'],
                                 statistics['target']))
         self._flush_counter += 1
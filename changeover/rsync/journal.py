@@ -0,0 +1,257 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+from changeover.common.settings import Settings
+from common import saxslog
+
+logger = logging.getLogger(__name__)
+
+
+class Journal(object):
+    """
+    Persistent record of the files of failed batches. The files are stored
+    per source directory, so all failed batches of a directory are retried
+    together. A directory is retried with an exponential backoff until its
+    files have been synced. As soon as any batch succeeds, the target is
+    assumed to be back and all directories are retried immediately.
+    """
+    def __init__(self, filename, min_backoff=10, max_backoff=600):
+        """
+        Constructor of the journal class. Creates the database if it doesn't
+        exist yet.
+        filename: the path to the SQLite database file
+        min_backoff: time in seconds before the first retry
+        max_backoff: the maximum time in seconds between two retries
+        """
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self._min_backoff = min_backoff
+        self._max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS pending "+
+                         "(path TEXT NOT NULL, name TEXT NOT NULL, "+
+                         "PRIMARY KEY (path, name))")
+        self._db.execute("CREATE TABLE IF NOT EXISTS retries "+
+                         "(path TEXT PRIMARY KEY, attempts INTEGER NOT NULL, "+
+                         "next_time REAL NOT NULL)")
+        self._db.commit()
+
+        # the directories with pending files. Saves a database write for
+        # every successful batch of a directory that isn't in the journal.
+        self._paths = set(row[0] for row in
+                          self._db.execute("SELECT path FROM retries"))
+        self._backoff = len(self._paths) > 0
+        self._inflight = set()
+
+    def __len__(self):
+        return len(self._paths)
+
+    def failed(self, path, file_list):
+        """
+        Records the files of a failed batch and schedules the next retry of
+        the directory.
+        path: the source directory
+        file_list: the names of the files of the batch
+        """
+        self._lock.acquire()
+        try:
+            self._db.executemany("INSERT OR IGNORE INTO pending VALUES (?, ?)",
+                                 ((path, f) for f in file_list))
+            row = self._db.execute("SELECT attempts FROM retries WHERE path=?",
+                                   (path,)).fetchone()
+            attempts = row[0]+1 if row != None else 1
+            backoff = min(self._max_backoff,
+                          self._min_backoff*(2**min(attempts-1, 30)))
+            self._db.execute("INSERT OR REPLACE INTO retries VALUES (?, ?, ?)",
+                             (path, attempts, time.time()+backoff))
+            self._db.commit()
+            self._paths.add(path)
+            self._inflight.discard(path)
+            self._backoff = True
+            logger.info("Journaled %i files of '%s', retry %i in %i s"%\
+                        (len(file_list), path, attempts, backoff))
+        except sqlite3.Error, e:
+            logger.error("Couldn't journal the files of '%s': %s"%(path, e))
+        finally:
+            self._lock.release()
+
+    def done(self, path, file_list):
+        """
+        Removes the files of a successful batch from the journal and
+        schedules the remaining directories for an immediate retry.
+        path: the source directory
+        file_list: the names of the synced files
+        """
+        if (not self._backoff) and (path not in self._paths):
+            return
+        self._lock.acquire()
+        try:
+            now = time.time()
+            self._inflight.discard(path)
+            if path in self._paths:
+                self._db.executemany("DELETE FROM pending WHERE path=? AND name=?",
+                                     ((path, f) for f in file_list))
+                row = self._db.execute("SELECT 1 FROM pending WHERE path=? LIMIT 1",
+                                       (path,)).fetchone()
+                if row == None:
+                    self._db.execute("DELETE FROM retries WHERE path=?", (path,))
+                    self._paths.discard(path)
+                else:
+                    self._db.execute("UPDATE retries SET attempts=0, next_time=? "+
+                                     "WHERE path=?", (now, path))
+
+            # the directories that are being retried are rescheduled when
+            # their batch has finished
+            if self._backoff:
+                waiting = [row[0] for row in
+                           self._db.execute("SELECT path FROM retries "+
+                                            "WHERE next_time>?", (now,))]
+                self._db.executemany("UPDATE retries SET attempts=0, next_time=? "+
+                                     "WHERE path=?",
+                                     ((now, p) for p in waiting
+                                      if p not in self._inflight))
+                self._backoff = False
+            self._db.commit()
+        except sqlite3.Error, e:
+            logger.error("Couldn't update the journal for '%s': %s"%(path, e))
+        finally:
+            self._lock.release()
+
+    def due(self, limit):
+        """
+        Returns the directories that are due for a retry together with up to
+        limit of their files, and postpones their next retry by the maximum
+        backoff. The retry is rescheduled by done() or failed() when the
+        batch has finished.
+        limit: the maximum number of files per directory
+        """
+        result = []
+        self._lock.acquire()
+        try:
+            now = time.time()
+            paths = [row[0] for row in
+                     self._db.execute("SELECT path FROM retries WHERE next_time<=?",
+                                      (now,))]
+            for path in paths:
+                names = [row[0] for row in
+                         self._db.execute("SELECT name FROM pending WHERE path=? "+
+                                          "LIMIT ?", (path, limit))]
+                if not names:
+                    self._db.execute("DELETE FROM retries WHERE path=?", (path,))
+                    self._paths.discard(path)
+                    continue
+                self._db.execute("UPDATE retries SET next_time=? WHERE path=?",
+                                 (now+self._max_backoff, path))
+                self._inflight.add(path)
+                result.append((path, names))
+            self._db.commit()
+        except sqlite3.Error, e:
+            logger.error("Couldn't read the journal: %s"%e)
+        finally:
+            self._lock.release()
+        return result
+
+    def discard(self, path, file_list):
+        """
+        Removes files from the journal without syncing them, e.g. because
+        they have been deleted from the source.
+        path: the source directory
+        file_list: the names of the files
+        """
+        self._lock.acquire()
+        try:
+            self._db.executemany("DELETE FROM pending WHERE path=? AND name=?",
+                                 ((path, f) for f in file_list))
+            row = self._db.execute("SELECT 1 FROM pending WHERE path=? LIMIT 1",
+                                   (path,)).fetchone()
+            if row == None:
+                self._db.execute("DELETE FROM retries WHERE path=?", (path,))
+                self._paths.discard(path)
+                self._inflight.discard(path)
+            self._db.commit()
+        except sqlite3.Error, e:
+            logger.error("Couldn't update the journal for '%s': %s"%(path, e))
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """
+        Closes the database.
+        """
+        self._lock.acquire()
+        try:
+            self._db.close()
+        finally:
+            self._lock.release()
+
+
+class Replayer(threading.Thread):
+    """
+    Thread class that feeds the files of the journal back into the watch
+    tree once their directory is due for a retry. The files are added in
+    chunks, so an outage of hours doesn't pile up the failed files in memory.
+    """
+    def __init__(self, watch_tree, journal, interval=5, chunk=1000):
+        """
+        Constructor of the replayer thread class
+        watch_tree: reference to the watch tree the files are added to
+        journal: reference to the journal of the failed batches
+        interval: time in seconds between two checks of the journal
+        chunk: the maximum number of files per directory that are added
+               per retry
+        """
+        super(Replayer, self).__init__(name="Replayer")
+        self.daemon = True
+        conf = Settings()
+        self._logger, self._raven_client = saxslog.setup(__name__,
+                                                         conf['logging']['debug'],
+                                                         conf['logging']['sentry'])
+        self._watch_tree = watch_tree
+        self._journal = journal
+        self._interval = interval
+        self._chunk = max(1, chunk)
+        self._stop_event = threading.Event()
+
+    def run(self):
+        """
+        The main run method of the thread.
+        """
+        while not self._stop_event.is_set():
+            try:
+                self._replay()
+            except Exception, e:
+                if self._raven_client != None:
+                    self._raven_client.captureException()
+                else:
+                    self._logger.error("Couldn't replay the journal: %s"%e)
+            self._stop_event.wait(self._interval)
+
+    def stop(self):
+        """
+        Stops the thread.
+        """
+        self._stop_event.set()
+
+    def _replay(self):
+        """
+        Adds the files of the directories that are due to the watch tree.
+        Files that no longer exist are removed from the journal.
+        """
+        for path, names in self._journal.due(self._chunk):
+            missing = []
+            for f in names:
+                try:
+                    size = os.stat(os.path.join(path, f)).st_size
+                except OSError:
+                    missing.append(f)
+                    continue
+                self._watch_tree.add_file(path, f, size)
+            if missing:
+                self._journal.discard(path, missing)
+            self._logger.info("Retrying %i journaled files in '%s'"%\
+                              (len(names)-len(missing), path))
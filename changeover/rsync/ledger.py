@@ -0,0 +1,148 @@
+import os
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Ledger(object):
+    """
+    Persistent record of what has been synced. For each source directory the
+    ledger stores the latest change time (ctime) of the files that were
+    successfully synced. The change time is used instead of the modification
+    time, as it is also updated if a file is moved into the directory. The
+    files of failed batches are recorded with their change time until they
+    are synced, so the latest change time of a later batch doesn't hide them.
+    """
+    def __init__(self, filename):
+        """
+        Constructor of the ledger class. Creates the database if it doesn't
+        exist yet.
+        filename: the path to the SQLite database file
+        """
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # a new ledger knows nothing about the files synced before it existed
+        self.new = self._db.execute("SELECT name FROM sqlite_master WHERE "+
+                                    "type='table' AND name='synced'").fetchone() == None
+        self._db.execute("CREATE TABLE IF NOT EXISTS synced "+
+                         "(path TEXT PRIMARY KEY, ctime REAL NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS failed "+
+                         "(path TEXT NOT NULL, name TEXT NOT NULL, "+
+                         "ctime REAL NOT NULL, PRIMARY KEY (path, name))")
+        self._db.commit()
+
+    def get(self, path):
+        """
+        Returns the change time up to which all files of a directory have
+        been synced or 0 if nothing has been synced from it yet. If files of
+        the directory failed to sync, the time lies before the earliest of
+        them.
+        path: the source directory
+        """
+        self._lock.acquire()
+        try:
+            row = self._db.execute("SELECT ctime FROM synced WHERE path=?",
+                                   (path,)).fetchone()
+            failed = self._db.execute("SELECT MIN(ctime) FROM failed WHERE path=?",
+                                      (path,)).fetchone()
+        finally:
+            self._lock.release()
+        ctime = row[0] if row != None else 0
+        if (failed != None) and (failed[0] != None):
+            ctime = min(ctime, failed[0]-1)
+        return ctime
+
+    def ctimes(self, path, file_list):
+        """
+        Returns a dictionary of the files of a directory and their change
+        times. Call it before the files are transferred, so the ledger
+        records the state rsync saw. Files that don't exist are left out.
+        path: the source directory
+        file_list: the names of the files
+        """
+        result = {}
+        for f in file_list:
+            try:
+                result[f] = os.stat(os.path.join(path, f)).st_ctime
+            except OSError:
+                pass
+        return result
+
+    def update(self, path, ctimes):
+        """
+        Records the files of a directory as synced.
+        path: the source directory
+        ctimes: dictionary of the synced files and their change times as
+                returned by ctimes() before the transfer
+        """
+        self._lock.acquire()
+        try:
+            # the failed files that have been synced now or don't exist anymore
+            names = [r[0] for r in self._db.execute("SELECT name FROM failed WHERE path=?",
+                                                    (path,))]
+            names = [n for n in names if (n in ctimes) or \
+                     not os.path.exists(os.path.join(path, n))]
+            self._db.executemany("DELETE FROM failed WHERE path=? AND name=?",
+                                 [(path, n) for n in names])
+
+            ctime = max(ctimes.itervalues()) if ctimes else 0
+            row = self._db.execute("SELECT ctime FROM synced WHERE path=?",
+                                   (path,)).fetchone()
+            if (ctime > 0) and ((row == None) or (row[0] < ctime)):
+                self._db.execute("INSERT OR REPLACE INTO synced VALUES (?, ?)",
+                                 (path, ctime))
+            self._db.commit()
+        except sqlite3.Error, e:
+            logger.error("Couldn't update the ledger for '%s': %s"%(path, e))
+        finally:
+            self._lock.release()
+
+    def seed(self, path, ctime):
+        """
+        Records a directory as synced up to a change time, unless the ledger
+        already has a record of it.
+        path: the source directory
+        ctime: the change time up to which the files are taken as synced
+        """
+        self._lock.acquire()
+        try:
+            self._db.execute("INSERT OR IGNORE INTO synced VALUES (?, ?)",
+                             (path, ctime))
+            self._db.commit()
+        except sqlite3.Error, e:
+            logger.error("Couldn't update the ledger for '%s': %s"%(path, e))
+        finally:
+            self._lock.release()
+
+    def failed(self, path, ctimes):
+        """
+        Records the files of a failed batch of a directory. They are synced
+        again by the reconciliation after a restart.
+        path: the source directory
+        ctimes: dictionary of the files and their change times
+        """
+        self._lock.acquire()
+        try:
+            self._db.executemany("INSERT OR REPLACE INTO failed VALUES (?, ?, ?)",
+                                 [(path, n, c) for n, c in ctimes.iteritems()])
+            self._db.commit()
+        except sqlite3.Error, e:
+            logger.error("Couldn't update the ledger for '%s': %s"%(path, e))
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """
+        Closes the database.
+        """
+        self._lock.acquire()
+        try:
+            self._db.close()
+        finally:
+            self._lock.release()
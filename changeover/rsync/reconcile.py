@@ -0,0 +1,169 @@
+import os
+import time
+import stat
+import Queue
+import threading
+from changeover.common import filters, syncutils
+from changeover.common.settings import Settings
+from common import saxslog
+
+
+class RateLimiter(object):
+    """
+    Token bucket that limits the number of files per second that are fed into
+    the batch pipeline. It is shared by all reconciliation workers.
+    """
+    def __init__(self, rate):
+        """
+        Constructor of the rate limiter class
+        rate: the maximum number of files per second (0: no limit)
+        """
+        self._rate = rate
+        self._tokens = rate
+        self._time = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a file may be fed into the pipeline.
+        """
+        if self._rate <= 0:
+            return
+        while True:
+            self._lock.acquire()
+            try:
+                now = time.time()
+                self._tokens = min(self._rate,
+                                   self._tokens+(now-self._time)*self._rate)
+                self._time = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_time = (1-self._tokens)/self._rate
+            finally:
+                self._lock.release()
+            time.sleep(wait_time)
+
+
+class Reconciler(threading.Thread):
+    """
+    Thread class that catches up with the files that were written while the
+    daemon was not running. It walks the source folders, compares the change
+    time of the files with the ledger and adds the missing files to the watch
+    tree, from where they are synced like any notified file.
+    A new ledger records all source folders as synced up to the start, as
+    the files written before were synced without it. Later on, a folder
+    without a record is new and all its files are added. Folders without
+    unsynced files are recorded, so they aren't taken as new on the next
+    start.
+    """
+    def __init__(self, watch_tree, ledger, exclude="", workers=4, rate=0,
+                 margin=0):
+        """
+        Constructor of the reconciler thread class
+        watch_tree: reference to the watch tree the files are added to
+        ledger: reference to the ledger of the synced files
+        exclude: an ExcludeFilter or a regex for excluding files
+        workers: number of folders that are scanned in parallel
+        rate: maximum number of files per second that are added (0: no limit)
+        margin: time in seconds the ledger is assumed to lag behind, e.g.
+                because of batches that were pending when the daemon stopped
+        """
+        super(Reconciler, self).__init__(name="Reconciler")
+        self.daemon = True
+        conf = Settings()
+        self._logger, self._raven_client = saxslog.setup(__name__,
+                                                         conf['logging']['debug'],
+                                                         conf['logging']['sentry'])
+        self._watch_tree = watch_tree
+        self._ledger = ledger
+        if isinstance(exclude, basestring):
+            exclude = filters.ExcludeFilter(exclude)
+        self._exclude = exclude
+        self._workers = max(1, workers)
+        self._limiter = RateLimiter(rate)
+        self._margin = margin
+        self._queue = Queue.Queue()
+        self._count_lock = threading.Lock()
+        self._count = 0
+        self._start_time = time.time()
+
+    def run(self):
+        """
+        The main run method of the thread. Scans the source folders with a
+        number of worker threads.
+        """
+        self._start_time = time.time()
+        try:
+            folders = syncutils.get_source_folders()
+        except Exception, e:
+            if self._raven_client != None:
+                self._raven_client.captureException()
+            else:
+                self._logger.error("Couldn't list the source folders: %s"%e)
+            return
+
+        for folder in folders:
+            self._queue.put(folder)
+        threads = []
+        for i in range(self._workers):
+            self._queue.put(None)
+            thread = threading.Thread(target=self._work,
+                                      name="ReconcileWorker-%i"%i)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        self._logger.info("Reconciliation of %i folders added %i files in %.1f s"%\
+                          (len(folders), self._count, time.time()-self._start_time))
+
+    def _work(self):
+        """
+        The main method of a worker thread. Scans folders until it receives
+        the stop marker.
+        """
+        while True:
+            folder = self._queue.get()
+            if folder == None:
+                return
+            try:
+                self._reconcile(folder)
+            except OSError, e:
+                self._logger.error("Couldn't reconcile '%s': %s"%(folder, e))
+
+    def _reconcile(self, folder):
+        """
+        Adds the files of a folder that changed after the last synced file
+        to the watch tree.
+        folder: the source folder
+        """
+        synced = self._ledger.get(folder)
+        if (not synced) and self._ledger.new:
+            self._ledger.seed(folder, self._start_time)
+            return
+        since = synced-self._margin if synced else 0
+        count = 0
+        for f in os.listdir(folder):
+            if self._exclude.excluded(f):
+                continue
+            try:
+                st = os.stat(os.path.join(folder, f))
+            except OSError:
+                continue
+            if (not stat.S_ISREG(st.st_mode)) or (st.st_ctime <= since):
+                continue
+            self._limiter.acquire()
+            self._watch_tree.add_file(folder, f, st.st_size)
+            count += 1
+
+        if count == 0 and not synced:
+            self._ledger.seed(folder, self._start_time)
+        if count > 0:
+            self._logger.info("Added %i unsynced files in '%s'"%(count, folder))
+            self._count_lock.acquire()
+            try:
+                self._count += count
+            finally:
+                self._count_lock.release()
@@ -21,6 +21,12 @@ if raven_client != None:
     saxslog.setup_logging(saxslog.SentryHandler(raven_client))
     logger.info("Raven is available. Logging will be sent to Sentry")
 
+# keep the list of source folders up to date instead of scanning for it
+if settings.Settings()['server']['watch_folders'] == True:
+    from changeover.server import folderwatch
+    folderwatch.FolderWatchThread().start()
+    logger.info("Watching the source folders")
+
 app = Flask(__name__)
 
 from changeover.server import views
@@ -1,35 +1,235 @@
+import os
+import time
+import Queue
+import socket
 import threading
-from changeover.common import syncutils
+import multiprocessing
+import paramiko
+from string import Template
+from changeover.common import checksum, sshpool, syncutils
 from changeover.common.settings import Settings
+from changeover.server import planner
 from common import saxslog
 
 
+class StageCounter(object):
+    """
+    Thread safe progress counters of a pipeline stage.
+    """
+    def __init__(self, name):
+        """
+        Constructor of the stage counter class
+        name: the name of the stage
+        """
+        self.name = name
+        self._lock = threading.Lock()
+        self._files_total = 0
+        self._bytes_total = 0
+        self._files_done = 0
+        self._bytes_done = 0
+        self._errors = 0
+        self._start_time = None
+        self._end_time = None
+
+    def add(self, files, size):
+        """
+        Adds files to the work of the stage.
+        files: the number of files
+        size: the number of bytes
+        """
+        self._lock.acquire()
+        try:
+            self._files_total += files
+            self._bytes_total += size
+        finally:
+            self._lock.release()
+
+    def done(self, files, size, errors=0):
+        """
+        Records finished work of the stage.
+        files: the number of finished files
+        size: the number of finished bytes
+        errors: the number of files that failed
+        """
+        self._lock.acquire()
+        try:
+            if self._start_time == None:
+                self._start_time = time.time()
+            self._files_done += files
+            self._bytes_done += size
+            self._errors += errors
+        finally:
+            self._lock.release()
+
+    def start(self):
+        """
+        Marks the start of the stage.
+        """
+        self._lock.acquire()
+        try:
+            if self._start_time == None:
+                self._start_time = time.time()
+        finally:
+            self._lock.release()
+
+    def finish(self):
+        """
+        Marks the end of the stage.
+        """
+        self._lock.acquire()
+        try:
+            self._end_time = time.time()
+        finally:
+            self._lock.release()
+
+    def status(self):
+        """
+        Returns a dictionary with the counters, the rates in files and bytes
+        per second and the estimated remaining time in seconds.
+        """
+        self._lock.acquire()
+        try:
+            result = {'name': self.name,
+                      'files_total': self._files_total,
+                      'files_done': self._files_done,
+                      'bytes_total': self._bytes_total,
+                      'bytes_done': self._bytes_done,
+                      'errors': self._errors,
+                      'finished': self._end_time != None,
+                      'files_rate': 0.0,
+                      'bytes_rate': 0.0,
+                      'eta': None}
+            if self._start_time != None:
+                elapsed = (self._end_time or time.time())-self._start_time
+                if elapsed > 0:
+                    result['files_rate'] = self._files_done/elapsed
+                    result['bytes_rate'] = self._bytes_done/elapsed
+        finally:
+            self._lock.release()
+
+        if result['finished']:
+            result['eta'] = 0
+        elif result['bytes_rate'] > 0:
+            result['eta'] = (result['bytes_total']-result['bytes_done'])/\
+                            result['bytes_rate']
+        elif result['files_rate'] > 0:
+            result['eta'] = (result['files_total']-result['files_done'])/\
+                            result['files_rate']
+        return result
+
+
+class Chunk(object):
+    """
+    A group of files of a source folder that moves through the pipeline.
+    Each file is a list of the name, the size, the archived flag, which is
+    True if an identical copy of the file exists on the archive, and the
+    modification time the file had when it was planned.
+    """
+    __slots__ = ('source', 'target', 'files')
+
+    def __init__(self, source, target, files):
+        self.source = source
+        self.target = target
+        self.files = files
+
+    def size(self, archived=None):
+        """
+        Returns the number of files and bytes of the chunk.
+        archived: only count the files with this archived flag (None: all)
+        """
+        files = [f for f in self.files if (archived == None) or (f[2] == archived)]
+        return len(files), sum(f[1] for f in files)
+
+
 class ChangeoverThread(threading.Thread):
     """
-    Thread class that performs the changeover
+    Thread class that performs the changeover. The new source folder is
+    created first, so the detector can carry on, then the existing source
+    folders are run through a pipeline of stages:
+    1) plan: diff the source folders against the archive
+    2) transfer: rsync the missing and changed files
+    3) verify: compare the checksums of the source and the archived files
+    4) delete: remove the archived files from the source
+    The stages run at the same time, connected by bounded queues of file
+    chunks. Only files that passed all previous stages reach the next one.
     """
     def __init__(self, folder_create=False, folder_folders={},
                        rsync_enabled=False, rsync_checksum=True,
                        rsync_compress=True, rsync_exclude=[],
-                       post_checksum=True, post_delete=False):
+                       post_checksum=True, post_delete=False, plan=None):
         """
         Constructor of the changeover thread class
+        folder_create: create a new source folder
+        folder_folders: the template values of the new source folder
+        rsync_enabled: transfer the missing and changed files
+        rsync_checksum: let rsync compare the files by checksum
+        rsync_compress: let rsync compress the data
+        rsync_exclude: list of glob patterns that should be excluded
+        post_checksum: verify the checksums of the archived files
+        post_delete: delete the archived files and the empty source folders
+        plan: the plan of a dry run, which is used instead of diffing the
+              source folders against the archive again. Files written or
+              changed since the dry run are transferred.
         """
-        super(ChangeoverThread, self).__init__()
+        super(ChangeoverThread, self).__init__(name="Changeover")
+        self.daemon = True
         conf = Settings()
         self._logger, self._raven_client = saxslog.setup(__name__,
                                                          conf['logging']['debug'],
                                                          conf['logging']['sentry'])
         self._stop = threading.Event()
+        self._folder_create = folder_create
+        self._folder_folders = folder_folders
+        self._options = "-a"
+        self._options += "c" if rsync_checksum else ""
+        self._options += "z" if rsync_compress else ""
+        if plan != None:
+            self._exclude = plan.exclude
+        else:
+            self._exclude = planner.exclude_filter(rsync_exclude)
+        self._chunk_files = max(1, int(conf['changeover']['chunk_files']))
+        self._queue_size = max(1, int(conf['changeover']['queue_size']))
+        self._hash_pool = None
+        self._dry_run = plan
+
+        # the stages after the planning: name, number of workers, method
+        self._stages = []
+        if rsync_enabled:
+            self._stages.append(('transfer', int(conf['changeover']['workers']),
+                                 self._transfer))
+        if post_checksum:
+            self._stages.append(('verify', int(conf['changeover']['verify_workers']),
+                                 self._verify))
+        if post_delete:
+            self._stages.append(('delete', 1, self._delete))
+        self._counters = [StageCounter('plan')]+\
+                         [StageCounter(name) for name, _, _ in self._stages]
+        self._queues = [Queue.Queue(self._queue_size) for _ in self._stages]
+        self._errors = []
+        self._errors_lock = threading.Lock()
+        self._workers_lock = threading.Lock()
+        self._new_folder = ""
+        self._start_time = None
+        self._end_time = None
 
     def run(self):
         """
         The main run method of the thread.
         """
-        self._stop.wait(10)
-        if self.stopped():
-            return
-        
+        self._start_time = time.time()
+        try:
+            if self._folder_create:
+                self._create_folder()
+            if not self.stopped():
+                self._run_pipeline()
+        except Exception, e:
+            self._error("The changeover failed: %s"%e)
+            if self._raven_client != None:
+                self._raven_client.captureException()
+        self._end_time = time.time()
+        self._logger.info("Changeover %s after %.1f s"%\
+                          ("stopped" if self.stopped() else "finished",
+                           self._end_time-self._start_time))
 
     def stop(self):
         """
@@ -42,3 +242,292 @@ class ChangeoverThread(threading.Thread):
         Returns the stop flag of the thread
         """
         return self._stop.is_set()
+
+    def status(self):
+        """
+        Returns a dictionary with the state of the changeover and the
+        counters of each stage.
+        """
+        self._errors_lock.acquire()
+        try:
+            errors = list(self._errors)
+        finally:
+            self._errors_lock.release()
+        end_time = self._end_time or time.time()
+        return {'running': self.is_alive(),
+                'stopped': self.stopped(),
+                'new_folder': self._new_folder,
+                'elapsed': end_time-self._start_time if self._start_time else 0,
+                'stages': [c.status() for c in self._counters],
+                'errors': errors}
+
+    def _error(self, msg):
+        """
+        Logs an error and records it for the status.
+        msg: the error message
+        """
+        self._logger.error(msg)
+        self._errors_lock.acquire()
+        try:
+            self._errors.append(msg)
+        finally:
+            self._errors_lock.release()
+
+    def _create_folder(self):
+        """
+        Creates the new source folder from the template values.
+        """
+        folder = Template(Settings()['source']['folder'])\
+                 .substitute(self._folder_folders)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self._new_folder = folder
+        self._logger.info("Created the new source folder '%s'"%folder)
+
+    def _run_pipeline(self):
+        """
+        Starts the worker threads of the stages, plans the chunks and waits
+        until all stages have finished or the changeover has been stopped.
+        """
+        if any(name == 'verify' for name, _, _ in self._stages):
+            processes = int(Settings()['changeover']['processes'])
+            self._hash_pool = multiprocessing.Pool(processes if processes > 0 else None)
+
+        threads = []
+        for i, (name, workers, method) in enumerate(self._stages):
+            workers = max(1, workers)
+            remaining = [workers]
+            for j in range(workers):
+                thread = threading.Thread(target=self._work,
+                                          args=(i, method, remaining),
+                                          name="Changeover-%s-%i"%(name, j))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+        try:
+            folders = self._plan()
+            for thread in threads:
+                thread.join()
+        finally:
+            if self._hash_pool != None:
+                self._hash_pool.terminate()
+                self._hash_pool.join()
+                self._hash_pool = None
+
+        # remove the emptied source folders, the deepest first
+        if (not self.stopped()) and any(n == 'delete' for n, _, _ in self._stages):
+            for folder in sorted(folders, key=len, reverse=True):
+                if (folder != self._new_folder) and not os.listdir(folder):
+                    try:
+                        os.rmdir(folder)
+                    except OSError, e:
+                        self._error("Couldn't remove the folder '%s': %s"%(folder, e))
+
+    def _plan(self):
+        """
+        Diffs the source folders against the archive, or takes the folder
+        plans of the dry run, and feeds the chunks into the pipeline. Returns
+        the list of planned source folders.
+        """
+        counter = self._counters[0]
+        counter.start()
+        skip = self._new_folder.rstrip("/")
+        if self._dry_run != None:
+            items = [p for p in self._dry_run.folders
+                     if p.folder.rstrip("/") != skip]
+        else:
+            items = [f for f in syncutils.get_source_folders()
+                     if f.rstrip("/") != skip]
+        folders = []
+        try:
+            for item in items:
+                if self.stopped():
+                    break
+                if isinstance(item, planner.FolderPlan):
+                    plan = item
+                    plan.refresh(self._exclude)
+                else:
+                    plan = planner.plan_folder(item, self._exclude)
+                folders.append(plan.folder)
+                if plan.error:
+                    counter.done(0, 0, 1)
+                    self._error("Couldn't plan the folder '%s': %s"%\
+                                (plan.folder, plan.error))
+                    continue
+                for j in range(0, len(plan.files), self._chunk_files):
+                    self._forward(0, Chunk(plan.source, plan.target,
+                                           [list(f) for f in
+                                            plan.files[j:j+self._chunk_files]]))
+        finally:
+            # mark the end of the planning for the first stage
+            if self._stages:
+                for _ in range(max(1, self._stages[0][1])):
+                    self._put(0, None)
+            counter.finish()
+        return folders
+
+    def _forward(self, stage, chunk):
+        """
+        Passes the files of a chunk that reached the end of a stage on to the
+        next stage. Files that aren't archived can only be passed on to the
+        transfer stage.
+        stage: the index of the stage the chunk is passed to
+        chunk: the chunk
+        """
+        if stage == 0:
+            n_files, size = chunk.size()
+            self._counters[0].add(n_files, size)
+            self._counters[0].done(n_files, size)
+        if (stage < len(self._stages)) and (self._stages[stage][0] != 'transfer'):
+            chunk.files = [f for f in chunk.files if f[2]]
+        if (stage >= len(self._stages)) or (not chunk.files):
+            return
+        if self._stages[stage][0] == 'transfer':
+            n_files, size = chunk.size(False)
+        else:
+            n_files, size = chunk.size()
+        self._counters[stage+1].add(n_files, size)
+        self._put(stage, chunk)
+
+    def _put(self, stage, item):
+        """
+        Puts an item into the queue of a stage. Blocks while the queue is
+        full, unless the changeover has been stopped.
+        stage: the index of the stage
+        item: the chunk or None as the end marker
+        """
+        while not self.stopped():
+            try:
+                self._queues[stage].put(item, True, 0.5)
+                return
+            except Queue.Full:
+                pass
+
+    def _work(self, stage, method, remaining):
+        """
+        The main method of a worker thread of a stage. Processes chunks until
+        it receives the end marker. The last worker of the stage passes the
+        end marker on to the next stage.
+        stage: the index of the stage
+        method: the method that processes a chunk
+        remaining: single element list with the number of running workers
+        """
+        counter = self._counters[stage+1]
+        counter.start()
+        while not self.stopped():
+            try:
+                chunk = self._queues[stage].get(True, 0.5)
+            except Queue.Empty:
+                continue
+            if chunk == None:
+                break
+            try:
+                method(chunk, counter)
+            except Exception, e:
+                n_files, size = chunk.size()
+                counter.done(0, 0, n_files)
+                self._error("The %s of %i files in '%s' failed: %s"%\
+                            (self._stages[stage][0], n_files, chunk.source, e))
+                continue
+            self._forward(stage+1, chunk)
+
+        self._workers_lock.acquire()
+        try:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        finally:
+            self._workers_lock.release()
+        if last:
+            counter.finish()
+            if stage+1 < len(self._stages):
+                for _ in range(max(1, self._stages[stage+1][1])):
+                    self._put(stage+1, None)
+
+    def _transfer(self, chunk, counter):
+        """
+        Copies the files of a chunk that aren't archived yet with rsync and
+        marks them as archived.
+        chunk: the chunk
+        counter: the counter of the stage
+        """
+        names = [f[0] for f in chunk.files if not f[2]]
+        if not names:
+            return
+        n_files, size = chunk.size(False)
+        pool = sshpool.pool()
+        client = pool.acquire()
+        broken = False
+        try:
+            if chunk.target not in syncutils.remote_dirs:
+                syncutils.mkdir_remote(chunk.target, client)
+                syncutils.remote_dirs.add(chunk.target)
+            syncutils.run_rsync(chunk.source, chunk.target, names, client,
+                                self._options, self._exclude.globs)
+        except (paramiko.SSHException, socket.error):
+            broken = True
+            raise
+        finally:
+            pool.release(client, broken)
+        for f in chunk.files:
+            f[2] = True
+        counter.done(n_files, size)
+
+    def _verify(self, chunk, counter):
+        """
+        Compares the checksums of the files of a chunk with their archived
+        copies. Only the verified files stay in the chunk.
+        chunk: the chunk
+        counter: the counter of the stage
+        """
+        conf = Settings()['changeover']
+        pairs = [(os.path.join(chunk.source, f[0]), os.path.join(chunk.target, f[0]))
+                 for f in chunk.files]
+        pool = sshpool.pool()
+        client = pool.acquire()
+        broken = False
+        try:
+            result = checksum.verify(pairs, client, conf['checksum'],
+                                     commands=int(conf['commands']),
+                                     pool=self._hash_pool)
+        except (paramiko.SSHException, socket.error):
+            broken = True
+            raise
+        finally:
+            pool.release(client, broken)
+
+        failed = set(result['mismatched']+result['missing'])
+        for path in result['mismatched']:
+            self._error("Checksum mismatch: %s"%path)
+        for path in result['missing']:
+            self._error("Couldn't verify: %s"%path)
+        verified = [f for f in chunk.files
+                    if os.path.join(chunk.source, f[0]) not in failed]
+        counter.done(len(verified), sum(f[1] for f in verified),
+                     len(chunk.files)-len(verified))
+        chunk.files = verified
+
+    def _delete(self, chunk, counter):
+        """
+        Deletes the archived files of a chunk from the source. Files whose
+        size or modification time changed since they were planned might not
+        have been archived in their current state and are kept.
+        chunk: the chunk
+        counter: the counter of the stage
+        """
+        n_files, size, errors = 0, 0, 0
+        for f in chunk.files:
+            path = os.path.join(chunk.source, f[0])
+            try:
+                st = os.stat(path)
+                if (st.st_size, int(st.st_mtime)) != (f[1], f[3]):
+                    errors += 1
+                    self._error("Not deleted, '%s' changed after it was planned"%path)
+                    continue
+                os.remove(path)
+                n_files += 1
+                size += f[1]
+            except OSError, e:
+                errors += 1
+                self._error("Couldn't delete '%s': %s"%(path, e))
+        counter.done(n_files, size, errors)
@@ -1,13 +1,11 @@
-import os
 import json
-import re
+import time
+import socket
 import logging
 import paramiko
-import socket
-import datetime
-import dateutil
-from subprocess import Popen, PIPE
-from changeover.common import syncutils
+import threading
+from changeover.common import filters, sshpool, syncutils
+from changeover.server import manifest
 from changeover.common.settings import Settings
 
 logger = logging.getLogger(__name__)
@@ -19,101 +17,150 @@ def folders():
     with a flag that indicates if the target folder exists.
     """
     result = {}
-    conf = Settings()
+    paths = []
+    for src_folder in syncutils.get_source_folders():
+        try:
+            paths.append(syncutils.build_sync_paths(src_folder))
+        except Exception, e:
+            logger.error("Couldn't build the target folder: %s"%e)
 
-    # get the list of source folders
-    src_folders = syncutils.get_source_folders()
+    try:
+        exists = target_dirs.exists([target for _, target in paths])
+    except (paramiko.SSHException, socket.error), e:
+        logger.error("Can't connect to target host: %s"%e)
+        return result
+    except Exception, e:
+        logger.error("Couldn't check target folders: %s"%e)
+        return result
 
-    # connect to the remote server
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    for source, target in paths:
+        result[source] = {'target': target,
+                          'exists': exists[target]}
+    return result
 
-    try:
-        client.connect(conf['target']['host'],
-                       username=conf['target']['user'], timeout=10)
 
-        # iterate over the source folders
-        for src_folder in src_folders:
-            source, target = syncutils.build_sync_paths(src_folder)
+class TargetDirCache(object):
+    """
+    Cache of the existence of target folders on the archive. The folders
+    that aren't cached or whose entry has expired are checked by a single
+    remote command: the paths are streamed to its stdin and the flags are
+    streamed back.
+    """
+    def __init__(self, ttl=30):
+        """
+        Constructor of the target directory cache class
+        ttl: the time in seconds an entry is valid
+        """
+        self._ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def exists(self, targets):
+        """
+        Returns a dictionary of the target folders and a flag that indicates
+        if the folder exists.
+        targets: the list of target folders
+        """
+        now = time.time()
+        result = {}
+        self._lock.acquire()
+        try:
+            for target in targets:
+                entry = self._entries.get(target)
+                if (entry != None) and (now-entry[1] < self._ttl):
+                    result[target] = entry[0]
+        finally:
+            self._lock.release()
+
+        unknown = [t for t in set(targets) if t not in result]
+        if len(unknown) > 0:
+            checked = self._check(unknown)
+            self._lock.acquire()
+            try:
+                for target, flag in checked.iteritems():
+                    self._entries[target] = (flag, now)
+            finally:
+                self._lock.release()
+            result.update(checked)
+        return result
 
-            # check if the target folder exists
-            target_exists = False
-            cmd = "[ -d \"%s\" ] && echo \"True\" || echo \"False\""%target
-            _, stdout, stderr = client.exec_command(cmd)
+    def _check(self, targets):
+        """
+        Checks the existence of folders on the archive. Returns a dictionary
+        of the folders and a flag that indicates if the folder exists.
+        targets: the list of target folders
+        """
+        cmd = "xargs -0 -r sh -c 'for d; do if [ -d \"$d\" ]; then " \
+              "printf \"1%s\\0\" \"$d\"; else printf \"0%s\\0\" \"$d\"; fi; done' sh"
+        pool = sshpool.pool()
+        client = pool.acquire(float(Settings()['server']['pool_timeout']))
+        broken = False
+        try:
+            stdin, stdout, stderr = client.exec_command(cmd)
+            feeder = threading.Thread(target=self._feed, args=(stdin, targets))
+            feeder.daemon = True
+            feeder.start()
+            data = stdout.read()
+            feeder.join()
             err = stderr.read()
             if err:
-                logger.error("Couldn't check target folder: %s"%err.rstrip())
-            else:
-                if stdout.read().rstrip() == "True":
-                    target_exists = True
-
-            result[source] = {'target': target,
-                              'exists': target_exists}
-    
-    except (paramiko.SSHException, socket.error), e:
-        logger.error("Can't connect to target host: %s"%e)
-    
-    finally:
-        client.close()
+                raise Exception(err.rstrip())
+        except (paramiko.SSHException, socket.error):
+            broken = True
+            raise
+        finally:
+            pool.release(client, broken)
+
+        result = dict.fromkeys(targets, False)
+        for record in data.split("\0"):
+            if record:
+                result[record[1:]] = (record[0] == "1")
         return result
 
+    def _feed(self, stdin, targets):
+        """
+        Writes the NUL-delimited folders to the stdin of the remote command
+        and closes it.
+        stdin: the stdin of the remote command
+        targets: the list of target folders
+        """
+        try:
+            stdin.write("\0".join(targets))
+        except (IOError, socket.error):
+            pass
+        finally:
+            stdin.channel.shutdown_write()
+
+
+target_dirs = TargetDirCache(float(Settings()['server']['folder_ttl']))
+
 
 def files(source, target):
     """
     Returns a file list comparing the specified source and target folders.
-    Assumes the target folder exists!
+    The target folder is listed by the manifest cache, so only the changes
+    since the last call are fetched from the archive.
     """
     result = {'files': {}}
     if (not source) or (not target):
         return result
 
-    conf = Settings()
-    regex = re.compile(conf['source']['exclude'])
-    datetime_epoch = datetime.datetime(1970, 1, 1)
-
-    # create source file list
-    src_files = {}
-    file_list = [f for f in os.listdir(source) \
-                 if os.path.isfile(os.path.join(source, f))]
-    for f in file_list:
-        if regex.search(f) == None:
-            filename = os.path.join(source, f)
-            src_files[f] = (os.path.getsize(filename),
-                            int(os.path.getmtime(filename)))
-
-    # create target file list
-    trg_files = {}
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    src_files = manifest.local_files(source, filters.exclude_filter())
     try:
-        client.connect(conf['target']['host'],
-                       username=conf['target']['user'], timeout=10)
-
-        # get the list of files
-        cmd = "TZ=\"UTC\" ls -l --time-style=full-iso %s"%target
-        _, stdout, stderr = client.exec_command(cmd)
-        err = stderr.read()
-        if err:
-            logger.error("Couldn't return remote file list: %s"%err.rstrip())
-        else:
-            file_list = stdout.read().split("\n")
-            for f in file_list:
-                ft = f.split()
-                if len(ft) > 8:
-                    trg_files[ft[8]] = (int(ft[4]),
-                     int((dateutil.parser.parse(ft[5]+"T"+ft[6])-datetime_epoch).total_seconds()))
-
+        trg_files = manifest.cache().get(target,
+                                         float(Settings()['server']['pool_timeout']))
     except (paramiko.SSHException, socket.error), e:
         logger.error("Can't connect to target host: %s"%e)
-
-    finally:
-        client.close()
+        trg_files = {}
+    except Exception, e:
+        logger.error("Couldn't return remote file list: %s"%e)
+        trg_files = {}
 
     # build result by comparing the source with the target list
+    missing = (None, None)
     for key, value in src_files.iteritems():
-        result['files'][key] = {'exists'   : key in trg_files,
-                                'same_size': (key in trg_files) and \
-                                             (trg_files[key][0] == value[0]),
-                                'same_date': (key in trg_files) and \
-                                             (trg_files[key][1] == value[1])}
+        trg_value = trg_files.get(key, missing)
+        result['files'][key] = {'exists'   : trg_value is not missing,
+                                'same_size': trg_value[0] == value[0],
+                                'same_date': trg_value[1] == value[1]}
     return result
@@ -0,0 +1,53 @@
+import logging
+import pyinotify
+import threading
+from changeover.common import syncutils, watchtree
+from changeover.common.settings import Settings
+
+logger = logging.getLogger(__name__)
+
+# only directory changes are of interest, not the data files written to them.
+# Without IN_CLOSE_WRITE the watch tree doesn't process any file.
+FOLDER_MASK = pyinotify.IN_CREATE | pyinotify.IN_DELETE | \
+              pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM
+
+
+class FolderHandler(watchtree.WatchTreeFileHandler):
+    """
+    Keeps the list of source folders of the server up to date with the
+    directories of the watch tree.
+    """
+    def tree_changed(self, added, removed):
+        """
+        Adds and removes the directories from the list of source folders
+        added: the paths of the added directories
+        removed: the paths of the removed directories
+        """
+        syncutils.source_folders.update(added, removed)
+
+
+class FolderWatchThread(threading.Thread):
+    """
+    Thread class that watches the directories below the source folder root,
+    so the files and changeover pages don't scan for the source folders.
+    """
+    def __init__(self):
+        """
+        Constructor of the folder watch thread class
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._tree = watchtree.WatchTree(FolderHandler(), mask=FOLDER_MASK)
+
+    def run(self):
+        """
+        The main run method of the thread. Builds the watch tree and handles
+        its events until the process exits.
+        """
+        try:
+            self._tree.create(Settings()['source']['watch'])
+            self._tree.watch()
+        except Exception, e:
+            logger.error("Stopped watching the source folders: %s"%e)
+        finally:
+            syncutils.source_folders.reset()
@@ -0,0 +1,178 @@
+import os
+import stat
+import socket
+import logging
+import paramiko
+import threading
+from pipes import quote
+from collections import OrderedDict
+from changeover.common import sshpool
+
+logger = logging.getLogger(__name__)
+
+# the record of a file in the remote listing: size, modification time, name
+FIND_FORMAT = "%s %T@ %f\\0"
+
+# the remote listing starts with the remote time, the modification time of
+# the folder and the mode (F: full listing, I: files changed since 'since').
+# Files created, deleted or renamed change the folder, so an unchanged
+# folder only needs the files changed in place. They are found by their
+# change time, which is also updated if only the modification time is set,
+# e.g. back to the older time of the source by rsync.
+LIST_COMMAND = "[ -d %(target)s ] || exit 0; " \
+               "m=$(find %(target)s -maxdepth 0 -printf '%%T@'); " \
+               "if [ \"$m\" = %(mtime)s ]; then mode=I; opt=\"-newerct @%(since)i\"; " \
+               "else mode=F; opt=; fi; " \
+               "printf '%%s %%s %%s\\0' \"$(date +%%s)\" \"$m\" \"$mode\"; " \
+               "find %(target)s -maxdepth 1 -type f $opt -printf '%(format)s'"
+
+
+class Manifest(object):
+    """
+    The listing of a target folder: a dictionary of the file names and their
+    size and modification time, the modification time of the folder and the
+    remote time of the listing.
+    """
+    __slots__ = ('files', 'mtime', 'fetched')
+
+    def __init__(self, files, mtime, fetched):
+        self.files = files
+        self.mtime = mtime
+        self.fetched = fetched
+
+
+class ManifestCache(object):
+    """
+    Cache of the listings of target folders. A cached listing is refreshed
+    by a single remote command, which only lists the files changed since
+    the last refresh if the folder itself hasn't changed.
+    """
+    def __init__(self, max_targets=32):
+        """
+        Constructor of the manifest cache class
+        max_targets: the maximum number of cached target folders
+        """
+        self._max_targets = max_targets
+        self._manifests = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, target, timeout=None):
+        """
+        Returns a dictionary of the names of the files in a target folder and
+        their size and modification time. The dictionary is empty if the
+        folder doesn't exist. Don't modify the dictionary, it is shared.
+        target: the target folder
+        timeout: maximum time in seconds to wait for a free SSH connection
+        """
+        self._lock.acquire()
+        try:
+            cached = self._manifests.pop(target, None)
+        finally:
+            self._lock.release()
+
+        manifest = self._fetch(target, cached, timeout)
+        if manifest == None:
+            return {}
+
+        self._lock.acquire()
+        try:
+            self._manifests[target] = manifest
+            while len(self._manifests) > self._max_targets:
+                self._manifests.popitem(last=False)
+        finally:
+            self._lock.release()
+        return manifest.files
+
+    def invalidate(self, target=None):
+        """
+        Drops the listing of a target folder or, if no folder is given, of
+        all folders.
+        target: the target folder
+        """
+        self._lock.acquire()
+        try:
+            if target == None:
+                self._manifests.clear()
+            else:
+                self._manifests.pop(target, None)
+        finally:
+            self._lock.release()
+
+    def _fetch(self, target, cached, timeout=None):
+        """
+        Lists a target folder on the archive. Returns the manifest or None if
+        the folder doesn't exist.
+        target: the target folder
+        cached: the cached manifest of the folder or None
+        timeout: maximum time in seconds to wait for a free SSH connection
+        """
+        cmd = LIST_COMMAND%{'target': quote(target),
+                            'mtime': quote(cached.mtime if cached != None else ""),
+                            'since': cached.fetched-1 if cached != None else 0,
+                            'format': FIND_FORMAT}
+        pool = sshpool.pool()
+        client = pool.acquire(timeout)
+        broken = False
+        try:
+            _, stdout, stderr = client.exec_command(cmd)
+            data = stdout.read()
+            err = stderr.read()
+            if err:
+                raise Exception(err.rstrip())
+        except (paramiko.SSHException, socket.error):
+            broken = True
+            raise
+        finally:
+            pool.release(client, broken)
+
+        if not data:
+            return None
+        header, _, records = data.partition("\0")
+        fetched, mtime, mode = header.rsplit(" ", 2)
+        if (mode == "I") and (cached != None):
+            files = dict(cached.files)
+            files.update(parse(records))
+        else:
+            files = parse(records)
+        return Manifest(files, mtime, int(fetched))
+
+
+def parse(records):
+    """
+    Parses the NUL-delimited records of a remote listing. Returns a
+    dictionary of the file names and their size and modification time.
+    records: the records in the format of FIND_FORMAT
+    """
+    result = {}
+    for record in records.split("\0"):
+        if record:
+            size, mtime, name = record.split(" ", 2)
+            result[name] = (int(size), int(mtime.partition(".")[0]))
+    return result
+
+
+def local_files(source, exclude):
+    """
+    Returns a dictionary of the names of the regular files in a source folder
+    and their size and modification time. Each file is stat'ed once.
+    source: the source folder
+    exclude: the exclude filter for the file names
+    """
+    result = {}
+    for name in exclude.filter(os.listdir(source)):
+        try:
+            st = os.stat(os.path.join(source, name))
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode):
+            result[name] = (st.st_size, int(st.st_mtime))
+    return result
+
+
+_cache = ManifestCache()
+
+def cache():
+    """
+    Returns the manifest cache shared by the views of the process.
+    """
+    return _cache
@@ -0,0 +1,172 @@
+import time
+import logging
+from multiprocessing.pool import ThreadPool
+from changeover.common import filters, syncutils
+from changeover.server import manifest, stats
+
+logger = logging.getLogger(__name__)
+
+
+class FolderPlan(object):
+    """
+    The difference between a source folder and its target folder on the
+    archive. Each file is a list of the name, the size, the archived flag,
+    which is True if an identical copy exists on the archive, and the
+    modification time.
+    """
+    __slots__ = ('folder', 'source', 'target', 'files', 'missing', 'changed',
+                 'error')
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.source = ""
+        self.target = ""
+        self.files = []
+        self.missing = [0, 0]
+        self.changed = [0, 0]
+        self.error = ""
+
+    def summary(self):
+        """
+        Returns a dictionary with the number of files and bytes that are
+        missing on the archive, that have changed and that are archived.
+        """
+        archived = [f for f in self.files if f[2]]
+        return {'source': self.source,
+                'target': self.target,
+                'files_missing': self.missing[0],
+                'bytes_missing': self.missing[1],
+                'files_changed': self.changed[0],
+                'bytes_changed': self.changed[1],
+                'files_archived': len(archived),
+                'bytes_archived': sum(f[1] for f in archived),
+                'error': self.error}
+
+    def refresh(self, exclude):
+        """
+        Updates the plan with the files that were written, changed or
+        deleted in the source folder since the plan was made. New and
+        changed files are marked as not archived. The archive isn't listed
+        again.
+        exclude: the exclude filter for the file names
+        """
+        if self.error:
+            return
+        try:
+            local_files = manifest.local_files(self.source, exclude)
+        except OSError, e:
+            self.error = str(e)
+            return
+        files = []
+        for f in self.files:
+            local = local_files.pop(f[0], None)
+            if local == (f[1], f[3]):
+                files.append(f)
+            elif local != None:
+                files.append([f[0], local[0], False, local[1]])
+        for name, local in local_files.iteritems():
+            files.append([name, local[0], False, local[1]])
+        self.files = files
+
+
+class Plan(object):
+    """
+    The result of a dry run of the changeover: the plans of all source
+    folders and the estimated duration of the transfer. The plan can be
+    handed to the changeover thread, which then doesn't scan the folders
+    again.
+    """
+    def __init__(self, folders, exclude):
+        """
+        Constructor of the plan class
+        folders: the list of folder plans
+        exclude: the exclude filter the plan was built with
+        """
+        self.folders = folders
+        self.exclude = exclude
+        self.created = time.time()
+
+    def summary(self, workers=1):
+        """
+        Returns a dictionary with the summary of each target folder, the
+        totals and the estimated duration of the transfer in seconds. The
+        duration is estimated from the historical throughput in the
+        statistics files. The per-file costs are shared by the workers,
+        the per-byte costs by the link.
+        workers: the number of transfer workers
+        """
+        result = {'created': self.created,
+                  'folders': [f.summary() for f in self.folders],
+                  'files_outstanding': 0,
+                  'bytes_outstanding': 0,
+                  'files_archived': 0,
+                  'bytes_archived': 0,
+                  'eta': None}
+        for folder in result['folders']:
+            result['files_outstanding'] += folder['files_missing']+folder['files_changed']
+            result['bytes_outstanding'] += folder['bytes_missing']+folder['bytes_changed']
+            result['files_archived'] += folder['files_archived']
+            result['bytes_archived'] += folder['bytes_archived']
+
+        rates = stats.throughput()
+        if rates['samples'] > 0:
+            result['eta'] = rates['seconds_per_file']*\
+                            result['files_outstanding']/max(1, workers) + \
+                            rates['seconds_per_byte']*result['bytes_outstanding']
+        return result
+
+
+def exclude_filter(globs):
+    """
+    Returns the exclude filter of the settings extended by glob patterns.
+    globs: list of additional glob patterns, e.g. from the changeover form
+    """
+    return filters.ExcludeFilter(filters.exclude_filter().regex,
+                                 filters.exclude_filter().globs+\
+                                 [g for g in globs if g])
+
+
+def plan_folder(folder, exclude):
+    """
+    Diffs a source folder against its target folder on the archive. Returns
+    a folder plan. Errors are recorded in the plan.
+    folder: the source folder
+    exclude: the exclude filter for the file names
+    """
+    result = FolderPlan(folder)
+    try:
+        result.source, result.target = syncutils.build_sync_paths(folder)
+        archived = manifest.cache().get(result.target)
+        for name, local in manifest.local_files(result.source, exclude).iteritems():
+            remote = archived.get(name)
+            if remote == None:
+                result.missing[0] += 1
+                result.missing[1] += local[0]
+            elif remote != local:
+                result.changed[0] += 1
+                result.changed[1] += local[0]
+            result.files.append([name, local[0], remote == local, local[1]])
+    except Exception, e:
+        result.error = str(e)
+        logger.error("Couldn't plan the folder '%s': %s"%(folder, e))
+    return result
+
+
+def build(exclude, skip=[], workers=4):
+    """
+    Plans the changeover of all source folders. The folders are diffed in
+    parallel. Returns the plan.
+    exclude: the exclude filter for the file names
+    skip: list of source folders that are left out, e.g. the new folder
+    workers: the number of folders that are diffed in parallel
+    """
+    skip = set(f.rstrip("/") for f in skip)
+    folders = [f for f in syncutils.get_source_folders()
+               if f.rstrip("/") not in skip]
+    pool = ThreadPool(max(1, workers))
+    try:
+        plans = pool.map(lambda f: plan_folder(f, exclude), folders)
+    finally:
+        pool.close()
+        pool.join()
+    return Plan(plans, exclude)
@@ -0,0 +1,56 @@
+// formats a number of bytes
+function formatBytes(bytes) {
+    var units = ["B", "kB", "MB", "GB", "TB"];
+    var i = 0;
+    while ((bytes >= 1000) && (i < units.length-1)) {
+        bytes /= 1000;
+        i += 1;
+    }
+    return bytes.toFixed(i > 0 ? 1 : 0)+" "+units[i];
+}
+
+// formats a number of seconds
+function formatSeconds(seconds) {
+    if (seconds == null) return "-";
+    seconds = Math.round(seconds);
+    var h = Math.floor(seconds/3600);
+    var m = Math.floor((seconds%3600)/60);
+    var s = seconds%60;
+    return (h > 0 ? h+"h " : "")+(h > 0 || m > 0 ? m+"m " : "")+s+"s";
+}
+
+// renders the outstanding files and bytes per target folder of a dry run
+function renderPlan(id, data) {
+    var rows = [];
+    $.each(data['folders'], function(i, folder) {
+        rows.push("<tr class=\""+(i%2 == 0 ? "odd" : "")+"\"><td>"+
+                  $('<div/>').text(folder['target'] || folder['error']).html()+"</td><td>"+
+                  (folder['files_missing']+folder['files_changed'])+"</td><td>"+
+                  formatBytes(folder['bytes_missing']+folder['bytes_changed'])+"</td><td>"+
+                  folder['files_archived']+"</td></tr>");
+    });
+    $('#'+id).html("<table class=\"file\"><tr class=\"header\"><th>Target</th><th>Files</th>"+
+                   "<th>Data</th><th>Archived</th></tr>"+rows.join("")+
+                   "</table><p>Outstanding: "+data['files_outstanding']+" files, "+
+                   formatBytes(data['bytes_outstanding'])+", ETA: "+formatSeconds(data['eta'])+"</p>");
+}
+
+// renders the stage counters and errors of the changeover status
+function renderStatus(id, data) {
+    var rows = [];
+    $.each(data['stages'], function(i, stage) {
+        rows.push("<tr class=\""+(i%2 == 0 ? "odd" : "")+"\"><td>"+stage['name']+
+                  "</td><td>"+stage['files_done']+" / "+stage['files_total']+
+                  "</td><td>"+formatBytes(stage['bytes_done'])+" / "+formatBytes(stage['bytes_total'])+
+                  "</td><td>"+formatBytes(stage['bytes_rate'])+"/s</td><td>"+
+                  stage['errors']+"</td><td>"+
+                  (stage['finished'] ? "done" : formatSeconds(stage['eta']))+"</td></tr>");
+    });
+    var errors = $.map(data['errors'] || [], function(msg) {
+        return "<li>"+$('<div/>').text(msg).html()+"</li>";
+    });
+    $('#'+id).html("<table class=\"file\"><tr class=\"header\"><th>Stage</th><th>Files</th>"+
+                   "<th>Data</th><th>Rate</th><th>Errors</th><th>ETA</th></tr>"+rows.join("")+
+                   "</table><p>Elapsed: "+formatSeconds(data['elapsed'])+
+                   (data['stopped'] ? " (stopped)" : "")+"</p><ul>"+errors.join("")+"</ul>");
+}
@@ -9,6 +9,91 @@ import random
 
 logger = logging.getLogger(__name__)
 
+# the optional columns between the rsync counters and the source path, in
+# the order they have been added to the statistics file
+EXTRA_COLUMNS = [('elapsed', float),
+                 ('bytes_saved', int),
+                 ('seconds_saved', float)]
+
+
+def parse_line(line):
+    """
+    Parses a line of a statistics file. Returns a dictionary with the date,
+    the rsync counters, the optional columns (None for lines written before
+    they were recorded), the source and the target, or None if the line
+    can't be read. The paths can contain spaces, so they are located by the
+    '=>' separator.
+    line: the line of the statistics file
+    """
+    sep = line.find(" => ")
+    if sep < 0:
+        return None
+    tokens = line[:sep].split(" ")
+    if len(tokens) < 6:
+        return None
+    try:
+        result = {'date': parser.parse(tokens[0]),
+                  'files_total': int(tokens[1]),
+                  'files_transferred': int(tokens[2]),
+                  'size_total': int(tokens[3]),
+                  'size_transferred': int(tokens[4]),
+                  'target': line[sep+4:].rstrip("\n")}
+        idx = 5
+        for key, convert in EXTRA_COLUMNS:
+            if (idx < len(tokens)) and not tokens[idx].startswith("/"):
+                result[key] = convert(tokens[idx])
+                idx += 1
+            else:
+                result[key] = None
+    except ValueError:
+        return None
+    result['source'] = " ".join(tokens[idx:])
+    return result
+
+
+def throughput():
+    """
+    Estimates the cost of transferring files from the statistics files.
+    The elapsed time of each rsync call is fitted by least squares as a
+    cost per file plus a cost per byte. Returns a dictionary with the
+    seconds per file, the seconds per byte and the number of rsync calls
+    the estimate is based on.
+    """
+    stats_files = glob.glob(Template(Settings()['statistics']['file'])\
+                            .safe_substitute({'year': "*", 'month': "*", 'day': "*"}))
+    ff, fb, bb, ft, bt, n = 0.0, 0.0, 0.0, 0.0, 0.0, 0
+    for stats_file in stats_files:
+        try:
+            curr_file = open(stats_file, 'r')
+            try:
+                for line in curr_file:
+                    entry = parse_line(line)
+                    if (entry == None) or (entry['elapsed'] == None) or \
+                       (entry['files_transferred'] == 0):
+                        continue
+                    f = float(entry['files_transferred'])
+                    b = float(entry['size_transferred'])
+                    t = entry['elapsed']
+                    ff += f*f
+                    fb += f*b
+                    bb += b*b
+                    ft += f*t
+                    bt += b*t
+                    n += 1
+            finally:
+                curr_file.close()
+        except IOError, e:
+            logger.error("Couldn't open statistics file: %s"%e)
+
+    result = {'seconds_per_file': 0.0, 'seconds_per_byte': 0.0, 'samples': n}
+    det = ff*bb-fb*fb
+    if (n > 0) and (det > 1e-9*ff*bb):
+        result['seconds_per_file'] = max(0.0, (ft*bb-bt*fb)/det)
+        result['seconds_per_byte'] = max(0.0, (bt*ff-ft*fb)/det)
+    elif (n > 0) and (ff > 0):
+        result['seconds_per_file'] = ft/ff
+    return result
+
 
 def aggregate(year=None, month=None, day=None):
     """
@@ -48,6 +133,8 @@ def aggregate(year=None, month=None, day=None):
                             .safe_substitute(date_dict))
 
     # loop over files and aggregate statistics    
+    bytes_saved = 0
+    seconds_saved = 0.0
     for stats_file in stats_files:
         try:
             curr_file = open(stats_file, 'r')
@@ -57,10 +144,15 @@ def aggregate(year=None, month=None, day=None):
                 if not line:
                     break
 
-                tokens = line.split()
-                line_date = parser.parse(tokens[0])
-                data_transferred = int(tokens[4]) * 954e-9  # bytes -> MB
-                files_transferred = int(tokens[2])
+                entry = parse_line(line)
+                if entry == None:
+                    logger.error("Couldn't read statistics line: %s"%line.rstrip())
+                    continue
+                line_date = entry['date']
+                data_transferred = entry['size_transferred'] * 954e-9  # bytes -> MB
+                files_transferred = entry['files_transferred']
+                bytes_saved += entry['bytes_saved'] or 0
+                seconds_saved += entry['seconds_saved'] or 0
 
                 idx = 0
                 if day != None:
@@ -87,6 +179,8 @@ def aggregate(year=None, month=None, day=None):
             logger.error("Couldn't open statistics file: %s"%e)
 
     # create output
+    result['bytes_saved'] = bytes_saved
+    result['seconds_saved'] = seconds_saved
     result['hist_data'] = []
     result['hist_file'] = []
     for i in range(len(bins)):
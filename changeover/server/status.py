@@ -3,6 +3,7 @@ import logging
 import socket
 import paramiko
 from subprocess import Popen, PIPE
+from changeover.common import sshpool
 from changeover.common.settings import Settings
 
 logger = logging.getLogger(__name__)
@@ -39,19 +40,14 @@ def rsync_running():
 
 
 def ssh_connected():
-    conf = Settings()
     result = {'connected': False,
               'error_msg': ""
              }
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    pool = sshpool.pool()
     try:
-        client.connect(conf['target']['host'],
-                       username=conf['target']['user'], timeout=10)
-        client.close()
+        pool.release(pool.acquire(float(Settings()['server']['pool_timeout'])))
         result['connected'] = True
     except (paramiko.SSHException, socket.error), e:
         logger.error("Can't connect to target host: %s"%e)
         result['error_msg'] = e
-        client.close()
     return result
@@ -1,8 +1,12 @@
-import json
+import time
+import logging
 from flask import render_template, request, jsonify, redirect, url_for, flash
 from changeover.server import app
+from changeover.common import filters
 from changeover.common.settings import Settings
-from changeover.server import status, stats, files, changeoverthread
+from changeover.server import status, stats, files, changeoverthread, planner
+
+logger = logging.getLogger(__name__)
 
 
 #---------------------------------
@@ -56,7 +60,7 @@ def web_changeover():
     curr_thread = getattr(app, 'changeover_thread', None)
     if (curr_thread != None) and (curr_thread.is_alive()):
         flash("Changeover is in progress.")
-        return redirect(url_for('changeover_progress'))
+        return redirect(url_for('web_changeover_progress'))
     else:
         conf = Settings()
         folders = []
@@ -64,7 +68,7 @@ def web_changeover():
             if folder.startswith('${') and folder.endswith('}'):
                 folders.append(folder[2:len(folder)-1])
 
-        exclude_str = ",".join(json.loads(conf['rsync']['exclude']))
+        exclude_str = ",".join(filters.exclude_filter().globs)
         return render_template("changeover_form.html",
                                detector_name = conf['server']['name'],
                                source_folder = conf['source']['folder'],
@@ -89,7 +93,7 @@ def web_changeover_progress():
                                    detector_name = conf['server']['name'])
         else:
             flash("No previous changeover process was found.")
-            return redirect(url_for('changeover'))
+            return redirect(url_for('web_changeover'))
 
 
 @app.route('/settings')
@@ -134,7 +138,19 @@ def rest_changeover_start():
                     co_params[key] = rf.get(key, False, type=bool)
         
         # read excludes
-        co_params['rsync_exclude'] = rf.get('rsync_exclude', "").split(","),
+        co_params['rsync_exclude'] = rf.get('rsync_exclude', "").split(",")
+
+        # take the plan of the dry run if it was built with the same excludes
+        # and is recent enough, otherwise the source folders are diffed again
+        curr_plan = getattr(app, 'changeover_plan', None)
+        max_age = float(Settings()['changeover']['plan_max_age'])
+        if rf.get('use_plan', False, type=bool) and (curr_plan != None) and \
+           (curr_plan.exclude.globs == planner.exclude_filter(co_params['rsync_exclude']).globs):
+            if time.time()-curr_plan.created <= max_age:
+                co_params['plan'] = curr_plan
+            else:
+                logger.info("The dry run is older than %i s, diffing again"%max_age)
+        app.changeover_plan = None
                      
         # convert folders to dictionary
         for key in rf.keys():
@@ -146,12 +162,31 @@ def rest_changeover_start():
         return jsonify(success=True)
 
 
+@app.route('/rest/changeover/plan', methods=['POST'])
+def rest_changeover_plan():
+    """
+    Runs a dry run of the changeover and returns the outstanding files and
+    bytes of each target folder and the estimated duration. The plan is kept
+    and can be executed by the next changeover without scanning again.
+    """
+    curr_thread = getattr(app, 'changeover_thread', None)
+    if (curr_thread != None) and (curr_thread.is_alive()):
+        return jsonify(success=False)
+    workers = int(Settings()['changeover']['workers'])
+    exclude = planner.exclude_filter(request.form.get('rsync_exclude', "").split(","))
+    app.changeover_plan = planner.build(exclude, workers=workers)
+    return jsonify(success=True, **app.changeover_plan.summary(workers))
+
+
 @app.route('/rest/changeover/status', methods=['GET'])
 def rest_changeover_status():
     """
     Returns the status of the changeover process
     """
-    pass
+    curr_thread = getattr(app, 'changeover_thread', None)
+    if curr_thread == None:
+        return jsonify(running=False, stages=[])
+    return jsonify(**curr_thread.status())
 
 
 @app.route('/rest/changeover/stop', methods=['POST'])
@@ -159,7 +194,11 @@ def rest_changeover_stop():
     """
     Stops the changeover process thread
     """
-    pass
+    curr_thread = getattr(app, 'changeover_thread', None)
+    if (curr_thread == None) or (not curr_thread.is_alive()):
+        return jsonify(success=False)
+    curr_thread.stop()
+    return jsonify(success=True)
 
 
 @app.route('/rest/settings', methods=['GET'])